@@ -29,7 +29,7 @@ class Bucket:
         if isinstance(metadata, resources.Bucket):
             self.metadata = metadata
         else:
-            metadata = utils.process_data(metadata)
+            metadata = utils.process_data(metadata, resources.Bucket)
             if not self.__validate_bucket_name(metadata["name"]):
                 utils.abort(
                     412, "Bucket name %s is invalid" % metadata["name"], context
@@ -42,10 +42,25 @@ class Bucket:
         )
         self.notification = []
         self.iam_policy = None
+        self.rest_cache = dict()
+        self.acl_index = dict()
+        self.default_object_acl_index = dict()
         self.__init_acl()
         self.__init_iam_policy(context)
         utils.insert_bucket(self)
 
+    @classmethod
+    def restore(cls, metadata, notification, iam_policy):
+        """Recreate a bucket from its stored state, without inserting it."""
+        bucket = cls.__new__(cls)
+        bucket.metadata = metadata
+        bucket.notification = notification
+        bucket.iam_policy = iam_policy
+        bucket.rest_cache = dict()
+        bucket.acl_index = dict()
+        bucket.default_object_acl_index = dict()
+        return bucket
+
     @classmethod
     def list(cls, project, context=None):
         if project is None or project.endswith("-"):
@@ -121,26 +136,29 @@ class Bucket:
         def make_acl_proto(entity, role):
             return resources.BucketAccessControl(entity=entity, role=role)
 
-        self.insert_acl(make_acl_proto("project-owners-123456789", "OWNER"))
-        self.insert_acl(make_acl_proto("project-editors-123456789", "OWNER"))
-        self.insert_acl(make_acl_proto("project-viewers-123456789", "READER"))
+        for entity, role in [
+            ("project-owners-123456789", "OWNER"),
+            ("project-editors-123456789", "OWNER"),
+            ("project-viewers-123456789", "READER"),
+        ]:
+            self.metadata.acl.append(
+                self.__make_acl(
+                    make_acl_proto(entity, role), resources.BucketAccessControl
+                )
+            )
 
         # TODO(vnvo2409): Check for predefinedDefaultObjectAcl
-        self.insert_default_object_acl(
-            utils.make_object_acl_proto(
-                self.metadata.name, "project-owners-123456789", "OWNER"
-            )
-        )
-        self.insert_default_object_acl(
-            utils.make_object_acl_proto(
-                self.metadata.name, "project-editors-123456789", "OWNER"
-            )
-        )
-        self.insert_default_object_acl(
-            utils.make_object_acl_proto(
-                self.metadata.name, "project-viewers-123456789", "READER"
+        for entity, role in [
+            ("project-owners-123456789", "OWNER"),
+            ("project-editors-123456789", "OWNER"),
+            ("project-viewers-123456789", "READER"),
+        ]:
+            self.metadata.default_object_acl.append(
+                self.__make_acl(
+                    utils.make_object_acl_proto(self.metadata.name, entity, role),
+                    resources.ObjectAccessControl,
+                )
             )
-        )
 
     def __init_iam_policy(self, context=None):
         role_mapping = {
@@ -168,13 +186,15 @@ class Bucket:
         if b"acl" in request.data or b"defaultObjectAcl" in request.data:
             projection = "full"
         projection = request.args.get("projection", projection)
-        result = utils.message_to_rest(
-            self.metadata, "storage#bucket", request.args.get("fields", None)
-        )
-        if projection == "noAcl":
-            result.pop("acl", None)
-            result.pop("defaultObjectAcl", None)
-            result.pop("owner", None)
+        fields = request.args.get("fields", None)
+        # The representations rendered since the last change of the metadata.
+        key = (self.metadata.metageneration, fields, projection)
+        result = self.rest_cache.get(key)
+        if result is None:
+            result = utils.message_to_rest(
+                self.metadata, "storage#bucket", fields, projection=projection
+            )
+            self.rest_cache[key] = result
         return result
 
     def update(self, data):
@@ -182,80 +202,93 @@ class Bucket:
         if isinstance(data, resources.Bucket):
             self.metadata.MergeFrom(data)
         else:
-            self.metadata = ParseDict(utils.process_data(data), self.metadata)
+            self.metadata = ParseDict(
+                utils.process_data(data, resources.Bucket), self.metadata
+            )
         if self.metadata.versioning.enabled:
             self.metadata.metageneration = metageneration + 1
+        utils.update_bucket(self)
 
     def delete(self):
         utils.delete_bucket(self.metadata.name)
 
-    def insert_acl(self, data, update=False):
+    def __make_acl(self, data, acl_type):
         acl = (
             data
-            if isinstance(data, resources.BucketAccessControl)
-            else ParseDict(utils.process_data(data), resources.BucketAccessControl())
+            if isinstance(data, acl_type)
+            else ParseDict(utils.process_data(data, acl_type), acl_type())
         )
         acl.etag = utils.random_etag(acl.entity + acl.role)
         acl.id = self.metadata.name + "/" + acl.entity
         acl.bucket = self.metadata.name
+        return acl
+
+    def insert_acl(self, data, update=False):
+        acl = self.__make_acl(data, resources.BucketAccessControl)
         if update:
             _, index = self.lookup_acl(acl.entity)
             self.metadata.acl[index].MergeFrom(acl)
-            return self.metadata.acl[index]
+            acl = self.metadata.acl[index]
         else:
             self.metadata.acl.append(acl)
-            return acl
+        utils.update_bucket(self)
+        return acl
 
     def lookup_acl(self, entity):
-        for i in range(len(self.metadata.acl)):
-            if self.metadata.acl[i].entity == entity:
-                return self.metadata.acl[i], i
-        utils.abort(404, "Acl %s does not exist" % entity)
+        index = utils.find_acl(self.metadata.acl, self.acl_index, entity)
+        if index is None:
+            utils.abort(404, "Acl %s does not exist" % entity)
+        return self.metadata.acl[index], index
 
     def delete_acl(self, entity):
         _, index = self.lookup_acl(entity)
         del self.metadata.acl[index]
+        self.acl_index.clear()
+        utils.update_bucket(self)
 
     def insert_default_object_acl(self, data, update=False):
-        acl = (
-            data
-            if isinstance(data, resources.ObjectAccessControl)
-            else ParseDict(utils.process_data(data), resources.ObjectAccessControl())
-        )
-        acl.etag = utils.random_etag(acl.entity + acl.role)
-        acl.id = self.metadata.name + "/" + acl.entity
-        acl.bucket = self.metadata.name
+        acl = self.__make_acl(data, resources.ObjectAccessControl)
         if update:
             _, index = self.lookup_default_object_acl(acl.entity)
             self.metadata.default_object_acl[index].MergeFrom(acl)
-            return self.metadata.default_object_acl[index]
+            acl = self.metadata.default_object_acl[index]
         else:
             self.metadata.default_object_acl.append(acl)
-            return acl
+        utils.update_bucket(self)
+        return acl
 
     def lookup_default_object_acl(self, entity):
-        for i in range(len(self.metadata.default_object_acl)):
-            if self.metadata.default_object_acl[i].entity == entity:
-                return self.metadata.default_object_acl[i], i
-        utils.abort(404, "Acl %s does not exist" % entity)
+        index = utils.find_acl(
+            self.metadata.default_object_acl, self.default_object_acl_index, entity
+        )
+        if index is None:
+            utils.abort(404, "Acl %s does not exist" % entity)
+        return self.metadata.default_object_acl[index], index
 
     def delete_default_object_acl(self, entity):
         _, index = self.lookup_default_object_acl(entity)
         del self.metadata.default_object_acl[index]
+        self.default_object_acl_index.clear()
+        utils.update_bucket(self)
 
     def insert_notification(self, data):
         noti = (
             data
             if isinstance(data, resources.Notification)
-            else ParseDict(utils.process_data(data), resources.Notification())
+            else ParseDict(
+                utils.process_data(data, resources.Notification),
+                resources.Notification(),
+            )
         )
         noti.id = "notification-%s" % str(random.random())
         self.notification.append(noti)
+        utils.update_bucket(self)
         return noti
 
     def delete_notification(self, notification_id):
         _, index = self.lookup_notification(notification_id)
         del self.notification[index]
+        utils.update_bucket(self)
 
     def lookup_notification(self, notification_id):
         for i in range(len(self.notification)):
@@ -271,4 +304,5 @@ class Bucket:
         )
         self.iam_policy.CopyFrom(policy)
         self.iam_policy.etag = utils.random_etag("iam_policy")
+        utils.update_bucket(self)
         return self.iam_policy
@@ -0,0 +1,301 @@
+# Copyright 2020 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Record the mutations of the testbench state in an append-only log.
+
+Each mutation is a record (in the format of `gcs_snapshot`) whose first field
+is the name of the mutating function in `utils`, followed by its serialized
+arguments. A background thread writes and fsyncs the pending records in
+batches (group commit), so the request threads only wait for the batch holding
+their own record. The log is replayed when it is opened.
+
+The media of an object is not copied while the mutation is applied, its record
+holds the (immutable) blob and the background thread writes the media. The
+media the disk backend already holds in a file is not copied at all, the record
+holds the path of a hard link to this file instead, in the `.media` directory
+next to the log.
+"""
+
+import json
+import os
+import threading
+import uuid
+
+import gcs_media
+import gcs_object
+import gcs_snapshot
+import gcs_upload
+import storage_resources_pb2 as resources
+import utils
+
+RECORD_MUTATION = b"M"
+
+# How a record holds the media of a blob, in the field following this one.
+MEDIA_INLINE = b"I"
+MEDIA_LINK = b"L"
+
+
+# encode the arguments of a mutation
+
+
+def _encode_generation(generation):
+    return str(generation if generation is not None else "").encode("utf-8")
+
+
+def _encode_object(obj):
+    """Return the metadata of an object, and whether its MD5 is still computed.
+
+    The MD5 computed in the background is not waited for, the replay computes
+    it again. `resolve_md5` sets the MD5 before it clears the future, so the
+    future is read first.
+    """
+    md5_pending = obj.md5_future is not None
+    return obj.metadata.SerializeToString(), b"1" if md5_pending else b"0"
+
+
+_ENCODERS = {
+    "insert_bucket": lambda bucket: gcs_snapshot.bucket_fields(bucket),
+    "update_bucket": lambda bucket: gcs_snapshot.bucket_fields(bucket),
+    "delete_bucket": lambda bucket_name: (bucket_name.encode("utf-8"),),
+    "insert_object": lambda bucket_name, obj: (bucket_name.encode("utf-8"), obj.blob)
+    + _encode_object(obj),
+    "delete_object": lambda bucket_name, object_name, generation=None: (
+        bucket_name.encode("utf-8"),
+        object_name.encode("utf-8"),
+        _encode_generation(generation),
+    ),
+    "update_object": _encode_object,
+    "insert_upload": lambda upload: (
+        upload.metadata.SerializeToString(),
+        gcs_snapshot.upload_state(upload),
+        bytes(upload.media),
+    ),
+    "update_upload": lambda upload, offset: (
+        upload.metadata.SerializeToString(),
+        gcs_snapshot.upload_state(upload),
+        str(offset).encode("utf-8"),
+        upload.read(offset),
+    ),
+    "delete_upload": lambda upload_id: (upload_id.encode("utf-8"),),
+}
+
+
+# apply a mutation, during the replay
+
+
+def _update_bucket(fields):
+    bucket = gcs_snapshot.restore_bucket(fields)
+    current = utils.lookup_bucket(bucket.metadata.name)
+    current.metadata = bucket.metadata
+    current.notification = bucket.notification
+    current.iam_policy = bucket.iam_policy
+    utils.update_bucket(current)
+
+
+def _insert_object(bucket_name, media_kind, media, metadata, md5_pending):
+    metadata = resources.Object.FromString(metadata)
+    md5_hash, crc32c = metadata.md5_hash or None, metadata.crc32c.value
+    if media_kind == MEDIA_LINK:
+        blob = gcs_media.store_file(media.decode("utf-8"), md5_hash, crc32c)
+    else:
+        blob = gcs_media.store(media, md5_hash, crc32c)
+    if md5_pending == b"1":
+        blob.md5_future()
+    obj = gcs_object.Object.restore(metadata, blob)
+    utils.insert_object(bucket_name.decode("utf-8"), obj)
+
+
+def _delete_object(bucket_name, object_name, generation):
+    utils.delete_object(
+        bucket_name.decode("utf-8"),
+        object_name.decode("utf-8"),
+        int(generation) if generation != b"" else None,
+    )
+
+
+def _update_object(metadata, md5_pending):
+    metadata = resources.Object.FromString(metadata)
+    obj = utils.lookup_object(metadata.bucket, metadata.name, str(metadata.generation))
+    if obj is not None:
+        obj.metadata = metadata
+        if md5_pending == b"1":
+            obj.md5_future = obj.blob.md5_future()
+        utils.update_object(obj)
+
+
+def _insert_upload(metadata, state, media):
+    utils.insert_upload(
+        gcs_upload.Upload.restore(
+            resources.Object.FromString(metadata), media, json.loads(state)
+        )
+    )
+
+
+def _update_upload(metadata, state, offset, media):
+    state = json.loads(state)
+    upload = utils.lookup_upload(state["upload_id"])
+    if upload is None:
+        return
+    # The media from `offset` may already be there, e.g. if a checkpoint
+    # happened between the change and its record.
+    offset = int(offset)
+    if offset != upload.committed_size:
+        upload.media = upload.media[:offset]
+    upload.append(offset, media)
+    upload.metadata = resources.Object.FromString(metadata)
+    upload.complete = state["complete"]
+
+
+_APPLY = {
+    "insert_bucket": lambda *fields: utils.insert_bucket(
+        gcs_snapshot.restore_bucket(fields)
+    ),
+    "update_bucket": lambda *fields: _update_bucket(fields),
+    "delete_bucket": lambda bucket_name: utils.delete_bucket(
+        bucket_name.decode("utf-8")
+    ),
+    "insert_object": _insert_object,
+    "delete_object": _delete_object,
+    "update_object": _update_object,
+    "insert_upload": _insert_upload,
+    "update_upload": _update_upload,
+    "delete_upload": lambda upload_id: utils.delete_upload(upload_id.decode("utf-8")),
+}
+
+
+class Journal(object):
+    """An append-only log of the mutations, with group commit.
+
+    `lock` is held by `utils.journaled` while a mutation is applied and
+    appended, it orders the records and lets `checkpoint` exclude mutations.
+    The pending records, and the progress of the writer thread, are guarded
+    by `flushed`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.media_directory = path + ".media"
+        os.makedirs(self.media_directory, exist_ok=True)
+        self.lock = threading.RLock()
+        self.flushed = threading.Condition()
+        self.pending = []
+        self.appended = 0
+        self.written = 0
+        self.error = None
+        self.replay()
+        self.file = open(path, "ab")
+        self.thread = threading.Thread(target=self.__write_loop, daemon=True)
+        self.thread.start()
+
+    def replay(self):
+        """Apply the mutations in the log, and drop a torn record at its end."""
+        if not os.path.exists(self.path):
+            return
+        end = 0
+        with open(self.path, "rb") as f:
+            for kind, fields in gcs_snapshot.read_records(f):
+                if kind == RECORD_MUTATION:
+                    _APPLY[fields[0].decode("utf-8")](*fields[1:])
+                end = f.tell()
+        os.truncate(self.path, end)
+
+    def append(self, name, *args, **kwargs):
+        """Queue the record of a mutation, return its sequence number.
+
+        Only the fields of the record are captured here, the media of the
+        blobs among them is written by the writer thread.
+        """
+        fields = (name.encode("utf-8"),) + _ENCODERS[name](*args, **kwargs)
+        with self.flushed:
+            self.pending.append(fields)
+            self.appended += 1
+            self.flushed.notify_all()
+            return self.appended
+
+    def wait(self, sequence):
+        """Block until the record `sequence` (and those before) is on disk."""
+        with self.flushed:
+            while self.written < sequence and self.error is None:
+                self.flushed.wait()
+            if self.error is not None:
+                raise self.error
+
+    def __write_loop(self):
+        while True:
+            with self.flushed:
+                while len(self.pending) == 0:
+                    self.flushed.wait()
+                batch, self.pending = self.pending, []
+                sequence = self.appended
+            try:
+                links = []
+                for fields in batch:
+                    self.__write(fields, links)
+                # The links (and the media they point to) are durable before
+                # the records referencing them.
+                for path in links + ([self.media_directory] if links else []):
+                    fd = os.open(path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as e:
+                with self.flushed:
+                    self.error = e
+                    self.flushed.notify_all()
+                return
+            with self.flushed:
+                self.written = sequence
+                self.flushed.notify_all()
+
+    def __write(self, fields, links):
+        record = []
+        for field in fields:
+            if not isinstance(field, gcs_media.Blob):
+                record.append(field)
+            elif isinstance(field, gcs_media.FileBlob) and self.__link(field, links):
+                record.extend((MEDIA_LINK, links[-1].encode("utf-8")))
+            else:
+                record.extend((MEDIA_INLINE, field))
+        gcs_snapshot.write_record(self.file, RECORD_MUTATION, *record)
+
+    def __link(self, blob, links):
+        """Add a hard link to the file of `blob` to `links`, if possible."""
+        path = os.path.abspath(
+            os.path.join(self.media_directory, uuid.uuid4().hex + ".media")
+        )
+        try:
+            os.link(blob.path, path)
+        except OSError:
+            return False
+        links.append(path)
+        return True
+
+    def checkpoint(self, save):
+        """Call `save` (e.g. to take a snapshot) then truncate the log.
+
+        No mutation happens in between, so the log only holds the mutations
+        made after `save` captured the state.
+        """
+        with self.lock:
+            with self.flushed:
+                sequence = self.appended
+            self.wait(sequence)
+            save()
+            self.file.truncate(0)
+            os.fsync(self.file.fileno())
+            # The media of the records is in the snapshot now.
+            for name in os.listdir(self.media_directory):
+                os.remove(os.path.join(self.media_directory, name))
@@ -0,0 +1,406 @@
+# Copyright 2020 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Implement the backends used to store the media of objects."""
+
+import abc
+import base64
+import bisect
+import collections
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from concurrent import futures
+
+CHUNK_SIZE = 1024 * 1024
+
+# Compute the MD5 of media off the request threads, `hashlib` releases the GIL
+# while hashing large buffers.
+_MD5_EXECUTOR = futures.ThreadPoolExecutor(thread_name_prefix="md5")
+_MD5_LOCK = threading.Lock()
+
+
+class Blob(abc.ABC):
+    """Represent the (immutable) media of an object.
+
+    The blobs created by `store` with the digests of their media are shared
+    by every object with the same media, `md5_hash` and `crc32c` hold these
+    digests (`None` if unknown).
+    """
+
+    size = 0
+    md5_hash = None
+    crc32c = None
+    _md5 = None
+
+    @abc.abstractmethod
+    def read(self, begin=0, end=None):
+        """Return the bytes in `[begin, end)`."""
+
+    def md5_future(self, start=True):
+        """Return a future of `md5_hash`, computed in the background if unknown.
+
+        Unless `start` is true, return `None` if the MD5 is not already known
+        or being computed.
+        """
+        if self._md5 is None and start:
+            with _MD5_LOCK:
+                if self._md5 is None and self.md5_hash is not None:
+                    self._md5 = futures.Future()
+                    self._md5.set_result(self.md5_hash)
+                elif self._md5 is None:
+                    self._md5 = _MD5_EXECUTOR.submit(self.__compute_md5)
+        return self._md5
+
+    def __compute_md5(self):
+        md5 = hashlib.md5()
+        for chunk in self.chunks():
+            md5.update(chunk)
+        self.md5_hash = base64.b64encode(md5.digest()).decode("utf-8")
+        return self.md5_hash
+
+    def chunks(self, begin=0, end=None, chunk_size=CHUNK_SIZE):
+        """Yield the bytes in `[begin, end)` in chunks of at most `chunk_size`."""
+        end = self.size if end is None else min(end, self.size)
+        for position in range(begin, end, chunk_size):
+            yield self.read(position, min(position + chunk_size, end))
+
+
+class MemoryBlob(Blob):
+    """A blob holding its media in memory."""
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.size = len(self.data)
+
+    def read(self, begin=0, end=None):
+        return self.data[begin:end]
+
+
+class MappedBlob(Blob):
+    """A blob reading its media from a region of a (shared) memory map."""
+
+    def __init__(self, mapping, offset, size):
+        self.mapping = mapping
+        self.offset = offset
+        self.size = size
+
+    def read(self, begin=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        if end <= begin:
+            return b""
+        return self.mapping[self.offset + begin : self.offset + end]
+
+
+class CompositeBlob(Blob):
+    """A blob concatenating the media of other blobs, without copying it.
+
+    The media is a list of segments, each one a (non composite) blob, so the
+    composite of composites references the original media directly.
+    """
+
+    def __init__(self, blobs):
+        self.segments = []
+        for blob in blobs:
+            if isinstance(blob, CompositeBlob):
+                self.segments.extend(blob.segments)
+            elif blob.size != 0:
+                self.segments.append(blob)
+        # The offset of each segment, followed by the total size.
+        self.offsets = [0]
+        for segment in self.segments:
+            self.offsets.append(self.offsets[-1] + segment.size)
+        self.size = self.offsets[-1]
+
+    def read(self, begin=0, end=None):
+        return b"".join(self.chunks(begin, end))
+
+    def chunks(self, begin=0, end=None, chunk_size=CHUNK_SIZE):
+        end = self.size if end is None else min(end, self.size)
+        index = bisect.bisect_right(self.offsets, begin) - 1
+        while begin < end and index < len(self.segments):
+            offset = self.offsets[index]
+            yield from self.segments[index].chunks(
+                begin - offset, min(end, self.offsets[index + 1]) - offset, chunk_size
+            )
+            begin = self.offsets[index + 1]
+            index += 1
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class FileBlob(Blob):
+    """A blob holding its media in a file, removed once the blob is unused."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        weakref.finalize(self, _remove_file, path)
+
+    def read(self, begin=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        if end <= begin:
+            return b""
+        with open(self.path, "rb") as f:
+            f.seek(begin)
+            return f.read(end - begin)
+
+    def chunks(self, begin=0, end=None, chunk_size=CHUNK_SIZE):
+        end = self.size if end is None else min(end, self.size)
+        with open(self.path, "rb") as f:
+            f.seek(begin)
+            position = begin
+            while position < end:
+                chunk = f.read(min(chunk_size, end - position))
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+
+
+class SpillBlob(Blob):
+    """A blob kept in memory while it is recently used, in a file otherwise.
+
+    The media is moved between memory and its file by the `SpillBackend`
+    that created the blob, `data` is `None` while it is only in the file.
+    """
+
+    def __init__(self, backend, key, data):
+        self.backend = backend
+        self.key = key
+        self.data = bytes(data)
+        self.size = len(self.data)
+
+    def read(self, begin=0, end=None):
+        return self.backend.load(self, begin, end)
+
+
+class MemoryBackend(object):
+    """Keep the media of objects in memory."""
+
+    def store(self, data):
+        return MemoryBlob(data)
+
+    def store_file(self, path):
+        with open(path, "rb") as f:
+            return self.store(f.read())
+
+
+class DiskBackend(object):
+    """Keep the media of objects in files under a scratch directory."""
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="gcs-testbench-")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def store(self, data):
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=".media")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return FileBlob(path, len(data))
+
+    def store_file(self, path):
+        """Store the media in the file `path`, as a hard link to it if possible."""
+        fd, scratch = tempfile.mkstemp(dir=self.directory, suffix=".media")
+        os.close(fd)
+        try:
+            os.link(path, scratch + ".link")
+            os.replace(scratch + ".link", scratch)
+        except OSError:
+            shutil.copyfile(path, scratch)
+        return FileBlob(scratch, os.path.getsize(scratch))
+
+
+class SpillBackend(object):
+    """Keep the media of objects in memory, up to `limit` bytes.
+
+    Past the limit the least recently read media are written to files under
+    a scratch directory and dropped from memory. They are read back into
+    memory the next time they are accessed. The media larger than the limit
+    on their own are never kept in memory (they would evict all the others),
+    they are written to their file when stored and always read from it.
+    """
+
+    def __init__(self, limit, directory=None):
+        self.disk = DiskBackend(directory)
+        self.limit = limit
+        # Reentrant, a blob may be finalized (see `__forget`) while it is held.
+        self.lock = threading.RLock()
+        self.keys = itertools.count()
+        self.blobs = weakref.WeakValueDictionary()
+        # The size of the blobs with their media in memory, least recently
+        # used first.
+        self.resident = collections.OrderedDict()
+        self.resident_size = 0
+        # The files of the blobs spilled at least once. The media is immutable,
+        # so a file is written once and kept (as a `FileBlob`) with its blob.
+        self.files = dict()
+
+    def store(self, data):
+        blob = SpillBlob(self, next(self.keys), data)
+        weakref.finalize(blob, self.__forget, blob.key)
+        if blob.size > self.limit:
+            # Nobody else holds the blob yet, write its file without the lock.
+            spilled = self.disk.store(blob.data)
+            with self.lock:
+                self.blobs[blob.key] = blob
+                self.files[blob.key] = spilled
+                blob.data = None
+            return blob
+        with self.lock:
+            self.blobs[blob.key] = blob
+            victims = self.__make_resident(blob)
+        self.__spill(victims)
+        return blob
+
+    def store_file(self, path):
+        with open(path, "rb") as f:
+            return self.store(f.read())
+
+    def load(self, blob, begin=0, end=None):
+        """Return the bytes in `[begin, end)` of `blob`, mark it as recently used.
+
+        The media of a spilled blob is read from its file without the lock.
+        """
+        with self.lock:
+            data = blob.data
+            if data is not None:
+                # Unless it is being spilled, see `__spill`.
+                if blob.key in self.resident:
+                    self.resident.move_to_end(blob.key)
+                return data[begin:end]
+            spilled = self.files[blob.key]
+        if blob.size > self.limit:
+            return spilled.read(begin, end)
+        data = spilled.read()
+        with self.lock:
+            victims = []
+            if blob.data is None:
+                blob.data = data
+                victims = self.__make_resident(blob)
+        self.__spill(victims)
+        return data[begin:end]
+
+    def __make_resident(self, blob):
+        """Add `blob` to the resident blobs and evict the least recently used.
+
+        Called with the lock held. The evicted blobs with a file are dropped
+        from memory now, the others are returned to be written by `__spill`.
+        """
+        self.resident[blob.key] = blob.size
+        self.resident_size += blob.size
+        victims = []
+        while self.resident_size > self.limit:
+            key, size = self.resident.popitem(last=False)
+            self.resident_size -= size
+            victim = self.blobs.get(key)
+            if victim is None:
+                continue
+            if key in self.files:
+                victim.data = None
+            else:
+                victims.append(victim)
+        return victims
+
+    def __spill(self, victims):
+        """Write the files of the evicted blobs, then drop them from memory.
+
+        Called without the lock, the blobs are still read from memory while
+        their file is written.
+        """
+        for victim in victims:
+            spilled = self.disk.store(victim.data)
+            with self.lock:
+                self.files[victim.key] = spilled
+                victim.data = None
+
+    def __forget(self, key):
+        with self.lock:
+            self.resident_size -= self.resident.pop(key, 0)
+            self.files.pop(key, None)
+
+
+BACKEND = MemoryBackend()
+
+
+def set_backend(name, directory=None, memory_limit=None):
+    """Select the backend used to store the media of new objects.
+
+    With a `memory_limit` (in bytes) the memory backend spills the least
+    recently used media to files under `directory`.
+    """
+    global BACKEND
+    if name == "memory" and memory_limit is not None:
+        BACKEND = SpillBackend(memory_limit, directory)
+    elif name == "memory":
+        BACKEND = MemoryBackend()
+    elif name == "disk":
+        BACKEND = DiskBackend(directory)
+    else:
+        raise ValueError("Unknown media backend %s" % name)
+
+
+# The blobs with known digests, keyed by digests and size. The entries are
+# weak, so a blob is released when the last object referencing it is gone.
+_SHARED = weakref.WeakValueDictionary()
+_SHARED_LOCK = threading.Lock()
+
+
+def store(data, md5_hash=None, crc32c=None):
+    """Store `data` in the current backend, return the resulting blob.
+
+    If the digests of `data` are given the media is stored once, the objects
+    with the same media all share the same blob.
+    """
+    if isinstance(data, Blob):
+        return data
+    return _store(lambda backend: backend.store(data), len(data), md5_hash, crc32c)
+
+
+def store_file(path, md5_hash=None, crc32c=None):
+    """Store the media in the file `path`, like `store`.
+
+    The disk backend links the file into its directory rather than copying it,
+    the file itself is left untouched.
+    """
+    return _store(
+        lambda backend: backend.store_file(path),
+        os.path.getsize(path),
+        md5_hash,
+        crc32c,
+    )
+
+
+def _store(make, size, md5_hash, crc32c):
+    if md5_hash is None:
+        return make(BACKEND)
+    key = (md5_hash, crc32c, size)
+    blob = _SHARED.get(key)
+    if blob is not None:
+        return blob
+    blob = make(BACKEND)
+    blob.md5_hash = md5_hash
+    blob.crc32c = crc32c
+    with _SHARED_LOCK:
+        return _SHARED.setdefault(key, blob)
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import functools
 import json
 import random
 import re
@@ -24,19 +26,63 @@ from google.iam.v1 import policy_pb2
 from google.protobuf.json_format import MessageToDict, Parse, ParseDict
 from google.protobuf.message import Message
 
+import gcs_media
 import gcs_upload
 import storage_pb2 as storage
 import storage_resources_pb2 as resources
 import utils
 
 
+# The MD5 of media at least this large is computed in the background, and only
+# waited for when needed.
+LAZY_MD5_SIZE = gcs_media.CHUNK_SIZE
+
+# The maximum (and default) number of items and prefixes in a page of a listing.
+MAX_RESULTS = 1000
+
+# The fields of the items of a listing that the metadata store can fill in
+# without loading the metadata of the objects.
+NAME_FIELDS = frozenset(["bucket", "name", "generation", "kind"])
+
+OWNER_ENTITY = "project-owners-123456789"
+
+# The entries (entity, role) added to the ACL of new objects, after the owner,
+# for each predefinedAcl.
+PREDEFINED_ACLS = {
+    "authenticatedRead": [("allAuthenticatedUsers", "READER")],
+    "bucketOwnerFullControl": [(OWNER_ENTITY, "OWNER")],
+    "bucketOwnerRead": [(OWNER_ENTITY, "READER")],
+    "private": [("project-owners", "OWNER")],
+    "publicRead": [("allUsers", "READER")],
+    "projectPrivate": [
+        ("project-editors-123456789", "OWNER"),
+        ("project-viewers-123456789", "READER"),
+    ],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _acl_template(predefined_acl):
+    """Return the ACL entries of a predefinedAcl, without the object fields.
+
+    The entries are built once, and copied to new objects which stamp their
+    own etag on them.
+    """
+    template = [resources.ObjectAccessControl(entity=OWNER_ENTITY, role="OWNER")]
+    for entity, role in PREDEFINED_ACLS[predefined_acl]:
+        template.append(resources.ObjectAccessControl(entity=entity, role=role))
+    return template
+
+
 class Object:
-    def __init__(self, metadata, media, args={}, headers={}, context=None):
+    def __init__(
+        self, metadata, media, args={}, headers={}, context=None, digests=None
+    ):
         timestamp = datetime.now(timezone.utc)
         if isinstance(metadata, resources.Object):
             self.metadata = metadata
         else:
-            metadata = utils.process_data(metadata)
+            metadata = utils.process_data(metadata, resources.Object)
             self.metadata = ParseDict(metadata, resources.Object())
         self.metadata.generation = self.__random_generation()
         self.metadata.metageneration = 1
@@ -47,9 +93,40 @@ class Object:
             + "#"
             + str(self.metadata.generation)
         )
-        self.media = media
-        self.metadata.size = len(self.media)
-        actual_md5Hash = utils.compute_md5(media)
+        self.md5_future = None
+        self.rest_cache = dict()
+        self.acl_index = dict()
+        if digests is not None:
+            # The (trusted) MD5 and CRC32C of the media, e.g. those of the
+            # source of a copy, whose MD5 may still be computed.
+            self.blob = gcs_media.store(media)
+            actual_md5Hash, actual_crc32c = digests
+            if actual_md5Hash == "":
+                self.md5_future = self.blob.md5_future(start=False)
+        else:
+            if not isinstance(media, gcs_media.Blob) and len(media) < LAZY_MD5_SIZE:
+                media = gcs_media.store(media, utils.compute_md5(media), crc32(media))
+            elif not isinstance(media, gcs_media.Blob):
+                actual_crc32c = crc32(media)
+                media = gcs_media.store(media)
+                media.crc32c = actual_crc32c
+            self.blob = media
+            if self.blob.crc32c is None:
+                # The media of other objects, e.g. the components of a
+                # composite, read in chunks.
+                actual_crc32c = 0
+                for chunk in self.blob.chunks():
+                    actual_crc32c = crc32(chunk, actual_crc32c)
+                self.blob.crc32c = actual_crc32c
+            actual_md5Hash, actual_crc32c = self.blob.md5_hash, self.blob.crc32c
+            if actual_md5Hash is None:
+                self.md5_future = self.blob.md5_future()
+                actual_md5Hash = ""
+            if self.md5_future is not None and self.metadata.md5_hash != "":
+                # The MD5 set by the client is a precondition, check it now.
+                actual_md5Hash = self.md5_future.result()
+                self.md5_future = None
+        self.metadata.size = self.blob.size
         if self.metadata.md5_hash != "" and actual_md5Hash != self.metadata.md5_hash:
             utils.abort(
                 412,
@@ -58,40 +135,144 @@ class Object:
                 context,
             )
         self.metadata.md5_hash = actual_md5Hash
-        self.metadata.crc32c.value = crc32(self.media)
+        self.metadata.crc32c.value = actual_crc32c
         self.metadata.time_created.FromDatetime(timestamp)
         self.metadata.updated.FromDatetime(timestamp)
         self.__update_acl(args, headers)
         utils.insert_object(self.metadata.bucket, self)
 
+    @classmethod
+    def restore(cls, metadata, blob):
+        """Recreate an object from its stored state, without inserting it.
+
+        If the metadata has no MD5 but the MD5 of the blob is (being) computed,
+        the object resolves its MD5 from the blob.
+        """
+        obj = cls.__new__(cls)
+        obj.metadata = metadata
+        obj.blob = blob
+        obj.md5_future = None
+        if metadata.md5_hash == "" and blob is not None:
+            obj.md5_future = blob.md5_future(start=False)
+        obj.rest_cache = dict()
+        obj.acl_index = dict()
+        return obj
+
+    def resolve_md5(self):
+        """Wait for the MD5 computed in the background (if any), return the metadata."""
+        future = self.md5_future
+        if future is not None:
+            self.metadata.md5_hash = future.result()
+            self.md5_future = None
+        return self.metadata
+
+    @property
+    def media(self):
+        return self.blob.read()
+
     @classmethod
     def __random_generation(cls):
         return random.getrandbits(63)
 
     @classmethod
-    def list(cls, bucket_name, args):
-        is_proto = isinstance(args, storage.ListObjectsRequest)
-        versions = args.versions if is_proto else args.get("versions", False)
-        prefix = args.prefix if is_proto else args.get("prefix", "")
-        delimiter = args.delimiter if is_proto else args.get("delimiter", "")
-        start_offset = args.get("startOffset", "")
-        end_offset = args.get("endOffset", "")
-        items = []
-        prefixes = set()
-        for obj in utils.all_objects(bucket_name, versions):
-            name = obj.metadata.name
-            if name.find(prefix) != 0:
-                continue
-            if name < start_offset:
-                continue
-            if end_offset != "" and name >= end_offset:
-                continue
-            delimiter_index = name.find(delimiter, len(prefix))
-            if delimiter != "" and delimiter_index > 0:
-                prefixes.add(name[: delimiter_index + 1])
+    def list(cls, bucket_name, args, result, context=None):
+        """Yield the metadata of the objects in a page of the listing `args`.
+
+        With a delimiter, the objects whose name contains it after the prefix
+        are not listed, their name up to the delimiter is added to
+        `result.prefixes` instead. Both count towards the size of the page. If
+        the listing continues past this page, `result.next_page_token` is set
+        to the (opaque) key to resume it from.
+
+        Only the fields of the items selected by the `fields` of `args` are
+        guaranteed to be set, the metadata store may skip loading the others.
+        """
+        item_fields = None
+        if isinstance(args, storage.ListObjectsRequest):
+            versions = args.versions
+            prefix = args.prefix
+            delimiter = args.delimiter
+            start_offset, end_offset = "", ""
+            match_glob = None
+            max_results = args.max_results
+            page_token = args.page_token
+        else:
+            versions = args.get("versions", "false").lower() == "true"
+            prefix = args.get("prefix", "")
+            delimiter = args.get("delimiter", "")
+            start_offset = args.get("startOffset", "")
+            end_offset = args.get("endOffset", "")
+            match_glob = args.get("matchGlob")
+            max_results = args.get("maxResults", "0")
+            if not max_results.isdecimal():
+                utils.abort(400, "Invalid maxResults %s" % max_results, context)
+            max_results = int(max_results)
+            page_token = args.get("pageToken", "")
+            item_fields = utils.list_item_fields(args.get("fields"))
+        if max_results <= 0 or max_results > MAX_RESULTS:
+            max_results = MAX_RESULTS
+        start, start_generation = "", None
+        if page_token != "":
+            start, start_generation = cls.__decode_page_token(page_token, context)
+        match = None
+        if match_glob is not None:
+            glob = utils.compile_glob(match_glob)
+            if glob is None:
+                utils.abort(400, "Invalid matchGlob %s" % match_glob, context)
+            # Only the names starting with the literal prefix may match.
+            literal, match = glob
+            start_offset = max(start_offset, literal)
+            end = utils.prefix_successor(literal) if literal != "" else None
+            if end is not None and (end_offset == "" or end < end_offset):
+                end_offset = end
+        count = 0
+        for entry in utils.all_objects(
+            bucket_name,
+            versions,
+            prefix,
+            max(start_offset, start),
+            end_offset,
+            start_generation,
+            delimiter,
+            match,
+            item_fields is not None and item_fields <= NAME_FIELDS,
+        ):
+            if count == max_results:
+                result.next_page_token = cls.__encode_page_token(*resume)
+                return
+            count += 1
+            if isinstance(entry, str):
+                result.prefixes.append(entry)
+                resume = (utils.prefix_successor(entry), None)
                 continue
-            items.append(obj.metadata)
-        return items, list(prefixes)
+            if versions:
+                resume = (entry.metadata.name, entry.metadata.generation)
+            else:
+                resume = (entry.metadata.name + "\0", None)
+            if item_fields is None or "md5Hash" in item_fields:
+                yield entry.resolve_md5()
+            elif len(item_fields) != 0:
+                yield entry.metadata
+
+    @classmethod
+    def __encode_page_token(cls, start, generation):
+        return base64.urlsafe_b64encode(
+            json.dumps([start, generation]).encode("utf-8")
+        ).decode("utf-8")
+
+    @classmethod
+    def __decode_page_token(cls, page_token, context=None):
+        """Return the name to resume a listing from, and the generation of
+        this name to resume after (if any)."""
+        try:
+            start, generation = json.loads(base64.urlsafe_b64decode(page_token))
+            if isinstance(start, str) and (
+                generation is None or isinstance(generation, int)
+            ):
+                return start, generation
+        except (ValueError, TypeError):
+            pass
+        utils.abort(400, "Invalid page token %s" % page_token, context)
 
     @classmethod
     def __parse_multipart_rest_request(cls, request):
@@ -158,9 +339,12 @@ class Object:
             dict() if "metadata" not in metadata else metadata["metadata"]
         )
         metadata["metadata"]["x_testbench_upload"] = "multipart"
+        checksums = None
+        if "md5Hash" in metadata or "crc32c" in metadata:
+            checksums = utils.Checksums(media)
         if "md5Hash" in metadata:
             metadata["metadata"]["x_testbench_md5"] = metadata["md5Hash"]
-            actual_md5Hash = utils.compute_md5(media)
+            actual_md5Hash = checksums.md5_hash()
             if actual_md5Hash != metadata["md5Hash"]:
                 utils.abort(
                     412,
@@ -170,7 +354,7 @@ class Object:
             del metadata["md5Hash"]
         if "crc32c" in metadata:
             metadata["metadata"]["x_testbench_crc32c"] = metadata["crc32c"]
-            actual_crc32c = utils.compute_crc32c(media)
+            actual_crc32c = checksums.crc32c_hash()
             if actual_crc32c != metadata["crc32c"]:
                 utils.abort(
                     400,
@@ -179,6 +363,8 @@ class Object:
                 )
             del metadata["crc32c"]
         metadata.update(utils.extract_encryption(request))
+        if checksums is not None:
+            media = gcs_media.store(media, checksums.md5_hash(), checksums.crc32c)
         obj = Object(metadata, media, request.args, request.headers)
         return obj
 
@@ -191,6 +377,7 @@ class Object:
         metadata = dict()
         metadata["bucket"] = bucket_name
         metadata["name"] = object_name
+        metadata["metadata"] = {"x_testbench_upload": "xml"}
         if "content-type" in request.headers:
             metadata["contentType"] = request.headers["content-type"]
         args = dict()
@@ -203,11 +390,13 @@ class Object:
         goog_hash = request.headers.get("x-goog-hash")
         md5hash = None
         crc32c = None
+        checksums = None
         if goog_hash is not None:
+            checksums = utils.Checksums(media)
             for hash in goog_hash.split(","):
                 if hash.startswith("md5="):
                     md5Hash = hash[4:]
-                    actual_md5Hash = utils.compute_md5(media)
+                    actual_md5Hash = checksums.md5_hash()
                     if actual_md5Hash != md5Hash:
                         utils.abort(
                             412,
@@ -216,7 +405,7 @@ class Object:
                         )
                 if hash.startswith("crc32c="):
                     crc32c = hash[7:]
-                    actual_crc32c = utils.compute_crc32c(media)
+                    actual_crc32c = checksums.crc32c_hash()
                     if actual_crc32c != crc32c:
                         utils.abort(
                             400,
@@ -224,8 +413,9 @@ class Object:
                             % (actual_crc32c, crc32c),
                         )
         utils.check_object_generation(bucket_name, object_name, args)
+        if checksums is not None:
+            media = gcs_media.store(media, checksums.md5_hash(), checksums.crc32c)
         obj = Object(metadata, media, request.args, request.headers)
-        obj.metadata.metadata["x_testbench_upload"] = "xml"
         return obj
 
     @classmethod
@@ -249,12 +439,15 @@ class Object:
                 utils.abort(412, "name not set in Objects: insert")
             utils.check_object_generation(bucket_name, object_name, request.args)
             obj = Object(
-                {"bucket": bucket_name, "name": object_name},
+                {
+                    "bucket": bucket_name,
+                    "name": object_name,
+                    "metadata": {"x_testbench_upload": "simple"},
+                },
                 media,
                 request.args,
                 request.headers,
             )
-            obj.metadata.metadata["x_testbench_upload"] = "simple"
             return obj
         if upload_type == "multipart":
             return cls.__insert_rest_multipart(bucket_name, request)
@@ -292,31 +485,41 @@ class Object:
         return obj
 
     def lookup_acl(self, entity):
-        for i in range(len(self.metadata.acl)):
-            if self.metadata.acl[i].entity == entity:
-                return self.metadata.acl[i], i
-        utils.abort(404, "Acl %s does not exist" % entity)
+        index = utils.find_acl(self.metadata.acl, self.acl_index, entity)
+        if index is None:
+            utils.abort(404, "Acl %s does not exist" % entity)
+        return self.metadata.acl[index], index
 
-    def insert_acl(self, data, update=False):
+    def __make_acl(self, data):
         acl = (
             data
             if isinstance(data, resources.ObjectAccessControl)
-            else ParseDict(utils.process_data(data), resources.ObjectAccessControl())
+            else ParseDict(
+                utils.process_data(data, resources.ObjectAccessControl),
+                resources.ObjectAccessControl(),
+            )
         )
         acl.etag = utils.random_etag(acl.entity + acl.role)
         acl.id = self.metadata.name + "/" + acl.entity
         acl.bucket = self.metadata.bucket
+        return acl
+
+    def insert_acl(self, data, update=False):
+        acl = self.__make_acl(data)
         if update:
             _, index = self.lookup_acl(acl.entity)
             self.metadata.acl[index].MergeFrom(acl)
-            return self.metadata.acl[index]
+            acl = self.metadata.acl[index]
         else:
             self.metadata.acl.append(acl)
-            return acl
+        utils.update_object(self)
+        return acl
 
     def delete_acl(self, entity):
         _, index = self.lookup_acl(entity)
         del self.metadata.acl[index]
+        self.acl_index.clear()
+        utils.update_object(self)
 
     def __update_acl(self, args, headers):
         predefined_acl = None
@@ -339,103 +542,39 @@ class Object:
             )
         if predefined_acl is None:
             predefined_acl = "projectPrivate"
-        owner_entity = "project-owners-123456789"
-        self.metadata.acl.append(
-            utils.make_object_acl_proto(
-                self.metadata.bucket,
-                owner_entity,
-                "OWNER",
-                self.metadata.name,
-            )
-        )
-        self.metadata.owner.entity = "project-owners-123456789"
+        if predefined_acl not in PREDEFINED_ACLS:
+            utils.abort(400, "Invalid predefinedAcl value")
+        self.metadata.owner.entity = OWNER_ENTITY
         self.metadata.owner.entity_id = (
-            self.metadata.bucket
-            + "/"
-            + self.metadata.name
-            + "/"
-            + "project-owners-123456789"
+            self.metadata.bucket + "/" + self.metadata.name + "/" + OWNER_ENTITY
         )
-        acl = None
-        if predefined_acl == "authenticatedRead":
-            acl = [
-                utils.make_object_acl_proto(
-                    self.metadata.bucket,
-                    "allAuthenticatedUsers",
-                    "READER",
-                    self.metadata.name,
-                )
-            ]
-        elif predefined_acl == "bucketOwnerFullControl":
-            acl = [
-                utils.make_object_acl_proto(
-                    self.metadata.bucket,
-                    owner_entity,
-                    "OWNER",
-                    self.metadata.name,
-                )
-            ]
-        elif predefined_acl == "bucketOwnerRead":
-            acl = [
-                utils.make_object_acl_proto(
-                    self.metadata.bucket,
-                    owner_entity,
-                    "READER",
-                    self.metadata.name,
+        for i, template in enumerate(_acl_template(predefined_acl)):
+            acl = self.metadata.acl.add()
+            acl.CopyFrom(template)
+            acl.bucket = self.metadata.bucket
+            acl.object = self.metadata.name
+            if i != 0:
+                acl.id = self.metadata.name + "/" + acl.entity
+                acl.etag = utils.compute_etag(
+                    acl.entity + acl.role + str(self.metadata.generation)
                 )
-            ]
-        elif predefined_acl == "private":
-            acl = [
-                utils.make_object_acl_proto(
-                    self.metadata.bucket,
-                    "project-owners",
-                    "OWNER",
-                    self.metadata.name,
-                )
-            ]
-        elif predefined_acl == "publicRead":
-            acl = [
-                utils.make_object_acl_proto(
-                    self.metadata.bucket,
-                    "allUsers",
-                    "READER",
-                    self.metadata.name,
-                )
-            ]
-        elif predefined_acl == "projectPrivate":
-            acl = [
-                utils.make_object_acl_proto(
-                    self.metadata.bucket,
-                    "project-editors-123456789",
-                    "OWNER",
-                    self.metadata.name,
-                ),
-                utils.make_object_acl_proto(
-                    self.metadata.bucket,
-                    "project-viewers-123456789",
-                    "READER",
-                    self.metadata.name,
-                ),
-            ]
-        else:
-            utils.abort(400, "Invalid predefinedAcl value")
-        for item in acl:
-            self.insert_acl(item)
-        pass
 
     def to_rest(self, request, fields=None):
         projection = "noAcl"
         if b"acl" in request.data:
             projection = "full"
         projection = request.args.get("projection", projection)
-        result = utils.message_to_rest(
-            self.metadata,
-            "storage#object",
-            request.args.get("fields", fields),
-        )
-        if projection == "noAcl":
-            result.pop("acl", None)
-            result.pop("owner", None)
+        fields = request.args.get("fields", fields)
+        # The representations rendered since the last change of the metadata.
+        key = (self.metadata.metageneration, fields, projection)
+        result = self.rest_cache.get(key)
+        if result is None:
+            if fields is None or "md5Hash" in fields:
+                self.resolve_md5()
+            result = utils.message_to_rest(
+                self.metadata, "storage#object", fields, projection=projection
+            )
+            self.rest_cache[key] = result
         return result
 
     def update(self, data):
@@ -451,18 +590,23 @@ class Object:
         if isinstance(data, resources.Object):
             self.metadata.MergeFrom(data)
         else:
-            self.metadata = ParseDict(utils.process_data(data), self.metadata)
+            self.metadata = ParseDict(
+                utils.process_data(data, resources.Object), self.metadata
+            )
         self.metadata.metadata.update(x_testbench_metadata)
         if versioning:
             self.metadata.metageneration = metageneration + 1
+        utils.update_object(self)
 
     def delete(self):
-        utils.delete_object(self.metadata.bucket, self.metadata.name)
+        utils.delete_object(
+            self.metadata.bucket, self.metadata.name, self.metadata.generation
+        )
 
     def media_rest(self, request):
         instructions = request.headers.get("x-goog-testbench-instructions")
         begin = 0
-        end = len(self.media)
+        end = self.blob.size
         if request.range is not None:
             begin = (
                 request.range.ranges[0][0]
@@ -474,17 +618,17 @@ class Object:
                 if request.range.ranges[0][1] is not None
                 else end
             )
-        length = len(self.media)
+        length = self.blob.size
         response_stream = None
         content_range = "bytes %d-%d/%d" % (begin, end - 1, length)
 
         def streamer():
-            return self.media[begin:end]
+            return self.blob.chunks(begin, end)
 
         response_stream = streamer
 
         if instructions == "return-corrupted-data":
-            media = utils.corrupt_media(self.media[begin:end])
+            media = utils.corrupt_media(self.blob.read(begin, end))
 
             def streamer():
                 return media
@@ -499,7 +643,7 @@ class Object:
                     chunk_end = min(r + chunk_size, end)
                     if r == begin:
                         time.sleep(10)
-                    yield self.media[r:chunk_end]
+                    yield self.blob.read(r, chunk_end)
 
             response_stream = streamer
 
@@ -511,7 +655,7 @@ class Object:
                     chunk_end = min(r + chunk_size, end)
                     if r == 256 * 1024:
                         time.sleep(10)
-                    yield self.media[r:chunk_end]
+                    yield self.blob.read(r, chunk_end)
 
             response_stream = streamer
 
@@ -527,7 +671,7 @@ class Object:
         if "x_testbench_crc32c" in self.metadata.metadata:
             header += "crc32c=" + utils.encode_crc32c(self.metadata.crc32c.value)
         if "x_testbench_md5" in self.metadata.metadata:
-            header += ",md5=" + str(self.metadata.md5_hash)
+            header += ",md5=" + str(self.resolve_md5().md5_hash)
         return header if header != "" else None
 
     def rewrite(self):
@@ -46,7 +46,6 @@ class Rewrite:
                 ).encode("utf-8")
             )
         )
-        self.media = b""
         utils.insert_rewrite(self)
 
     def to_rest(self, request, fields=None):
@@ -72,33 +71,34 @@ class Rewrite:
         total_bytes_rewritten = rewrite.status.total_bytes_rewritten
         total_bytes_rewritten += (
             1024 * 1024
-            if 1024 * 1024 <= len(source.media) - total_bytes_rewritten
-            else len(source.media) - total_bytes_rewritten
+            if 1024 * 1024 <= source.blob.size - total_bytes_rewritten
+            else source.blob.size - total_bytes_rewritten
         )
-        rewrite.status.object_size = len(source.media)
-        rewrite.media += source.media[
-            rewrite.status.total_bytes_rewritten : total_bytes_rewritten
-        ]
-        rewrite.status.total_bytes_rewritten = len(rewrite.media)
-        if total_bytes_rewritten == len(source.media):
+        rewrite.status.object_size = source.blob.size
+        # The destination shares the media of the source, there is nothing to
+        # copy, only the progress is simulated.
+        rewrite.status.total_bytes_rewritten = total_bytes_rewritten
+        if total_bytes_rewritten == source.blob.size:
             utils.check_object_generation(
                 rewrite.request.destination_bucket,
                 rewrite.request.destination_object,
                 request.args,
             )
-            destination_metadata = source.metadata
+            destination_metadata = resources.Object()
+            destination_metadata.CopyFrom(source.metadata)
             destination_metadata.bucket = rewrite.request.destination_bucket
             destination_metadata.name = rewrite.request.destination_object
             destination_obj = gcs_object.Object(
                 destination_metadata,
-                source.media,
+                source.blob,
                 request.args,
                 request.headers,
+                digests=(source.metadata.md5_hash, source.metadata.crc32c.value),
             )
             destination_obj.update(request.data)
             rewrite.status.object_size = rewrite.status.total_bytes_rewritten
             rewrite.status.done = True
             rewrite.status.rewrite_token = ""
-            rewrite.status.resource.MergeFrom(destination_obj.metadata)
+            rewrite.status.resource.MergeFrom(destination_obj.resolve_md5())
         result = rewrite.to_rest(request)
         return result
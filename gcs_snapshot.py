@@ -0,0 +1,244 @@
+# Copyright 2020 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Save and restore the state of the testbench.
+
+A snapshot is a directory with two files. `media` holds the media of every
+object and upload, back to back. `state` holds a sequence of records, each
+one a kind byte, the number of fields, and the fields themselves prefixed by
+their length. The media is memory-mapped on restore, so it is only read when
+an object is downloaded.
+"""
+
+import json
+import mmap
+import os
+import struct
+
+from google.iam.v1 import policy_pb2
+
+import gcs_bucket
+import gcs_media
+import gcs_object
+import gcs_project
+import gcs_upload
+import storage_resources_pb2 as resources
+import utils
+
+STATE_FILE = "state"
+MEDIA_FILE = "media"
+
+RECORD_BUCKET = b"B"
+RECORD_OBJECT = b"O"
+RECORD_UPLOAD = b"U"
+RECORD_PROJECTS = b"P"
+
+_record_header = struct.Struct(">cI")
+_field_header = struct.Struct(">Q")
+_media_range = struct.Struct(">QQ")
+
+
+def write_record(f, kind, *fields):
+    """Write a record, the media of a field holding a blob is written in chunks."""
+    f.write(_record_header.pack(kind, len(fields)))
+    for field in fields:
+        if isinstance(field, gcs_media.Blob):
+            f.write(_field_header.pack(field.size))
+            for chunk in field.chunks():
+                f.write(chunk)
+        else:
+            f.write(_field_header.pack(len(field)))
+            f.write(field)
+
+
+def read_records(f):
+    """Yield the `(kind, fields)` of each record, stop at a truncated one."""
+    while True:
+        header = f.read(_record_header.size)
+        if len(header) != _record_header.size:
+            return
+        kind, count = _record_header.unpack(header)
+        fields = []
+        for _ in range(count):
+            header = f.read(_field_header.size)
+            if len(header) != _field_header.size:
+                return
+            (length,) = _field_header.unpack(header)
+            field = f.read(length)
+            if len(field) != length:
+                return
+            fields.append(field)
+        yield kind, fields
+
+
+def bucket_fields(bucket):
+    return (
+        bucket.metadata.SerializeToString(),
+        resources.ListNotificationsResponse(
+            items=bucket.notification
+        ).SerializeToString(),
+        bucket.iam_policy.SerializeToString(),
+    )
+
+
+def restore_bucket(fields):
+    return gcs_bucket.Bucket.restore(
+        resources.Bucket.FromString(fields[0]),
+        list(resources.ListNotificationsResponse.FromString(fields[1]).items),
+        policy_pb2.Policy.FromString(fields[2]),
+    )
+
+
+def upload_state(upload):
+    state = {
+        "upload_id": upload.upload_id,
+        "location": upload.location,
+        "committed_size": upload.committed_size,
+        "complete": upload.complete,
+        "inject_upload_data_error": upload.inject_upload_data_error,
+    }
+    if hasattr(upload, "args"):
+        state["args"] = dict(upload.args)
+    return json.dumps(state).encode("utf-8")
+
+
+class _MediaWriter(object):
+    """Append blobs to the media file, writing each distinct blob once."""
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+        self.offsets = dict()
+
+    def write(self, blob):
+        if id(blob) not in self.offsets:
+            self.offsets[id(blob)] = (self.offset, blob)
+            for chunk in blob.chunks():
+                self.f.write(chunk)
+            self.offset += blob.size
+        return _media_range.pack(self.offsets[id(blob)][0], blob.size)
+
+
+def _projects_state():
+    projects = []
+    for project in gcs_project.VALID_PROJECTS.values():
+        projects.append(
+            {
+                "project_id": project.project_id,
+                "project_number": project.project_number,
+                "service_accounts": {
+                    email: sa.keys for email, sa in project.service_accounts.items()
+                },
+            }
+        )
+    return {
+        "key_id_generator": gcs_project.ServiceAccount.key_id_generator,
+        "project_number_generator": gcs_project.GcsProject.project_number_generator,
+        "projects": projects,
+    }
+
+
+def _restore_projects(state):
+    for item in state["projects"]:
+        project = gcs_project.GcsProject.__new__(gcs_project.GcsProject)
+        project.project_id = item["project_id"]
+        project.project_number = item["project_number"]
+        project.service_accounts = {}
+        for email, keys in item["service_accounts"].items():
+            sa = gcs_project.ServiceAccount(email)
+            sa.keys = keys
+            project.service_accounts[email] = sa
+        gcs_project.VALID_PROJECTS[project.project_id] = project
+    gcs_project.ServiceAccount.key_id_generator = state["key_id_generator"]
+    gcs_project.GcsProject.project_number_generator = state["project_number_generator"]
+
+
+def save(directory):
+    """Write the state of the testbench to a snapshot in `directory`."""
+    os.makedirs(directory, exist_ok=True)
+    state_path = os.path.join(directory, STATE_FILE)
+    media_path = os.path.join(directory, MEDIA_FILE)
+    # Write new files and rename them, a running testbench may have the
+    # current media file mapped.
+    with open(state_path + ".tmp", "wb") as state, open(
+        media_path + ".tmp", "wb"
+    ) as media:
+        writer = _MediaWriter(media)
+        for bucket_name, bucket in utils.all_buckets():
+            write_record(state, RECORD_BUCKET, *bucket_fields(bucket))
+            for obj in utils.all_objects(bucket_name, True):
+                live = utils.lookup_object(bucket_name, obj.metadata.name)
+                is_live = (
+                    live is not None
+                    and live.metadata.generation == obj.metadata.generation
+                )
+                write_record(
+                    state,
+                    RECORD_OBJECT,
+                    obj.resolve_md5().SerializeToString(),
+                    b"1" if is_live else b"0",
+                    writer.write(obj.blob),
+                )
+        for upload in utils.all_uploads():
+            write_record(
+                state,
+                RECORD_UPLOAD,
+                upload.metadata.SerializeToString(),
+                upload_state(upload),
+                writer.write(gcs_media.MemoryBlob(upload.media)),
+            )
+        write_record(
+            state, RECORD_PROJECTS, json.dumps(_projects_state()).encode("utf-8")
+        )
+    os.replace(media_path + ".tmp", media_path)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def load(directory):
+    """Restore the state of the testbench from the snapshot in `directory`."""
+    mapping = None
+    with open(os.path.join(directory, MEDIA_FILE), "rb") as media:
+        if os.fstat(media.fileno()).st_size != 0:
+            mapping = mmap.mmap(media.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # The objects sharing a blob when saved share it again.
+    blobs = dict()
+
+    def blob(field):
+        if field not in blobs:
+            offset, size = _media_range.unpack(field)
+            if size == 0:
+                blobs[field] = gcs_media.MemoryBlob(b"")
+            else:
+                blobs[field] = gcs_media.MappedBlob(mapping, offset, size)
+        return blobs[field]
+
+    with open(os.path.join(directory, STATE_FILE), "rb") as state:
+        for kind, fields in read_records(state):
+            if kind == RECORD_BUCKET:
+                utils.insert_bucket(restore_bucket(fields))
+            elif kind == RECORD_OBJECT:
+                obj = gcs_object.Object.restore(
+                    resources.Object.FromString(fields[0]), blob(fields[2])
+                )
+                utils.restore_object(obj.metadata.bucket, obj, fields[1] == b"1")
+            elif kind == RECORD_UPLOAD:
+                utils.insert_upload(
+                    gcs_upload.Upload.restore(
+                        resources.Object.FromString(fields[0]),
+                        blob(fields[2]).read(),
+                        json.loads(fields[1]),
+                    )
+                )
+            elif kind == RECORD_PROJECTS:
+                _restore_projects(json.loads(fields[0]))
@@ -0,0 +1,327 @@
+# Copyright 2020 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Implement a metadata store for buckets and objects on top of SQLite."""
+
+import contextlib
+import sqlite3
+import threading
+
+from google.iam.v1 import policy_pb2
+
+import gcs_bucket
+import gcs_object
+import storage_resources_pb2 as resources
+import utils
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    metadata BLOB NOT NULL,
+    notification BLOB NOT NULL,
+    iam_policy BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    bucket TEXT NOT NULL,
+    name TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    live INTEGER NOT NULL,
+    metadata BLOB NOT NULL,
+    PRIMARY KEY (bucket, name, generation)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS objects_live
+    ON objects (bucket, name) WHERE live = 1;
+"""
+
+
+class SqliteStore(object):
+    """Keep the metadata of buckets and objects in a SQLite database.
+
+    The database runs in WAL mode, with one connection per thread, so readers
+    do not block the (serialized) writers. The metadata is stored as
+    serialized protos, while the object media stays in the media backend and
+    only a reference to each blob is kept in memory, in `blobs`: a dict from
+    each bucket to the blobs of its objects, by name and generation.
+
+    The metadata is stored without waiting for an MD5 computed in the
+    background, the objects restored from it resolve their MD5 from the blob
+    (see `gcs_object.Object.restore`).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self.blobs = dict()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+        # The media of any previous run is gone, so is its metadata.
+        connection.execute("DELETE FROM objects")
+        connection.execute("DELETE FROM buckets")
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.write_lock:
+            connection = self.connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    # buckets
+
+    def __restore_bucket(self, row):
+        metadata, notification, iam_policy = row
+        return gcs_bucket.Bucket.restore(
+            resources.Bucket.FromString(metadata),
+            list(resources.ListNotificationsResponse.FromString(notification).items),
+            policy_pb2.Policy.FromString(iam_policy),
+        )
+
+    def __bucket_row(self, bucket):
+        return (
+            bucket.metadata.SerializeToString(),
+            resources.ListNotificationsResponse(
+                items=bucket.notification
+            ).SerializeToString(),
+            bucket.iam_policy.SerializeToString(),
+            bucket.metadata.name,
+        )
+
+    def insert_bucket(self, bucket):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets"
+                " (metadata, notification, iam_policy, name) VALUES (?, ?, ?, ?)",
+                self.__bucket_row(bucket),
+            )
+
+    def update_bucket(self, bucket):
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE buckets SET metadata = ?, notification = ?, iam_policy = ?"
+                " WHERE name = ?",
+                self.__bucket_row(bucket),
+            )
+
+    def lookup_bucket(self, bucket_name):
+        row = (
+            self.connection()
+            .execute(
+                "SELECT metadata, notification, iam_policy FROM buckets"
+                " WHERE name = ?",
+                (bucket_name,),
+            )
+            .fetchone()
+        )
+        return self.__restore_bucket(row) if row is not None else None
+
+    def all_buckets(self):
+        rows = self.connection().execute(
+            "SELECT name, metadata, notification, iam_policy FROM buckets"
+            " ORDER BY name"
+        )
+        return [(row[0], self.__restore_bucket(row[1:])) for row in rows]
+
+    def delete_bucket(self, bucket_name):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM objects WHERE bucket = ?", (bucket_name,))
+            connection.execute("DELETE FROM buckets WHERE name = ?", (bucket_name,))
+            self.blobs.pop(bucket_name, None)
+
+    # objects
+
+    def __restore_object(self, bucket_name, name, generation, metadata):
+        blob = self.blobs.get(bucket_name, {}).get((name, generation))
+        return gcs_object.Object.restore(resources.Object.FromString(metadata), blob)
+
+    def __check_bucket(self, bucket_name, context=None):
+        row = (
+            self.connection()
+            .execute("SELECT 1 FROM buckets WHERE name = ?", (bucket_name,))
+            .fetchone()
+        )
+        if row is None:
+            utils.abort(404, "Bucket %s does not exist" % bucket_name, context=context)
+
+    def all_objects(
+        self,
+        bucket_name,
+        versions,
+        prefix="",
+        start_offset="",
+        end_offset="",
+        start_generation=None,
+        delimiter="",
+        match=None,
+        names_only=False,
+    ):
+        self.__check_bucket(bucket_name)
+        start = max(prefix, start_offset)
+        while start is not None:
+            query = "SELECT name, generation, %s FROM objects WHERE bucket = ?" % (
+                "NULL" if names_only else "metadata"
+            )
+            if not versions:
+                query += " AND live = 1"
+            query += " AND name >= ?"
+            parameters = [bucket_name, start]
+            if start_generation is not None:
+                query += " AND (name > ? OR generation > ?)"
+                parameters += [start, start_generation]
+            if end_offset != "":
+                query += " AND name < ?"
+                parameters.append(end_offset)
+            query += " ORDER BY name, generation"
+            rows = self.connection().execute(query, parameters)
+            start, start_generation = None, None
+            for name, generation, metadata in rows:
+                if not name.startswith(prefix):
+                    break
+                if match is not None and match(name) is None:
+                    continue
+                name_prefix = utils.delimited_prefix(name, prefix, delimiter)
+                if name_prefix is not None:
+                    # Query again past all the names starting with the prefix.
+                    yield name_prefix
+                    start = utils.prefix_successor(name_prefix)
+                    break
+                if names_only:
+                    yield gcs_object.Object.restore(
+                        resources.Object(
+                            bucket=bucket_name, name=name, generation=generation
+                        ),
+                        self.blobs.get(bucket_name, {}).get((name, generation)),
+                    )
+                else:
+                    yield self.__restore_object(bucket_name, name, generation, metadata)
+
+    def lookup_object(
+        self, bucket_name, object_name, current_generation="", context=None
+    ):
+        self.__check_bucket(bucket_name, context=context)
+        if current_generation == "":
+            row = (
+                self.connection()
+                .execute(
+                    "SELECT generation, metadata FROM objects"
+                    " WHERE bucket = ? AND name = ? AND live = 1",
+                    (bucket_name, object_name),
+                )
+                .fetchone()
+            )
+        elif current_generation.isdecimal():
+            row = (
+                self.connection()
+                .execute(
+                    "SELECT generation, metadata FROM objects"
+                    " WHERE bucket = ? AND name = ? AND generation = ?",
+                    (bucket_name, object_name, int(current_generation)),
+                )
+                .fetchone()
+            )
+        else:
+            row = None
+        if row is None:
+            return None
+        return self.__restore_object(bucket_name, object_name, *row)
+
+    def __delete_object(self, connection, bucket, object_name, generation):
+        live = connection.execute(
+            "SELECT generation, metadata FROM objects"
+            " WHERE bucket = ? AND name = ? AND live = 1",
+            (bucket.metadata.name, object_name),
+        ).fetchone()
+        if generation is None or (live is not None and live[0] == generation):
+            if live is None:
+                return None
+            generation = live[0]
+            if bucket.metadata.versioning.enabled:
+                connection.execute(
+                    "UPDATE objects SET live = 0"
+                    " WHERE bucket = ? AND name = ? AND generation = ?",
+                    (bucket.metadata.name, object_name, generation),
+                )
+                return self.__restore_object(bucket.metadata.name, object_name, *live)
+        row = connection.execute(
+            "SELECT generation, metadata FROM objects"
+            " WHERE bucket = ? AND name = ? AND generation = ?",
+            (bucket.metadata.name, object_name, generation),
+        ).fetchone()
+        if row is None:
+            return None
+        connection.execute(
+            "DELETE FROM objects WHERE bucket = ? AND name = ? AND generation = ?",
+            (bucket.metadata.name, object_name, generation),
+        )
+        obj = self.__restore_object(bucket.metadata.name, object_name, *row)
+        self.blobs.get(bucket.metadata.name, {}).pop((object_name, generation), None)
+        return obj
+
+    def delete_object(self, bucket_name, object_name, generation=None):
+        bucket = self.lookup_bucket(bucket_name)
+        if bucket is None:
+            utils.abort(404, "Bucket %s does not exist" % bucket_name)
+        with self.transaction() as connection:
+            return self.__delete_object(connection, bucket, object_name, generation)
+
+    def insert_object(self, bucket_name, obj):
+        bucket = self.lookup_bucket(bucket_name)
+        if bucket is None:
+            utils.abort(404, "Bucket %s does not exist" % bucket_name)
+        with self.transaction() as connection:
+            self.__delete_object(connection, bucket, obj.metadata.name, None)
+            self.__insert_object(connection, obj, True)
+
+    def __insert_object(self, connection, obj, live):
+        key = (obj.metadata.bucket, obj.metadata.name, obj.metadata.generation)
+        connection.execute(
+            "INSERT INTO objects (bucket, name, generation, live, metadata)"
+            " VALUES (?, ?, ?, ?, ?)",
+            key + (1 if live else 0, obj.metadata.SerializeToString()),
+        )
+        self.blobs.setdefault(obj.metadata.bucket, dict())[
+            (obj.metadata.name, obj.metadata.generation)
+        ] = obj.blob
+
+    def restore_object(self, bucket_name, obj, live):
+        with self.transaction() as connection:
+            self.__insert_object(connection, obj, live)
+
+    def update_object(self, obj):
+        metadata = obj.metadata.SerializeToString()
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE objects SET metadata = ?"
+                " WHERE bucket = ? AND name = ? AND generation = ?",
+                (
+                    metadata,
+                    obj.metadata.bucket,
+                    obj.metadata.name,
+                    obj.metadata.generation,
+                ),
+            )
@@ -18,6 +18,7 @@ import re
 import flask
 from google.protobuf.json_format import MessageToDict, Parse, ParseDict
 
+import gcs_media
 import storage_pb2 as storage
 import storage_resources_pb2 as resources
 import utils
@@ -57,7 +58,9 @@ class Upload:
                 metadata["name"] = request.args.get("name")
             if metadata.get("name") is None:
                 utils.abort(400, "Missing object name argument")
-            self.metadata = ParseDict(utils.process_data(metadata), resources.Object())
+            self.metadata = ParseDict(
+                utils.process_data(metadata, resources.Object), resources.Object()
+            )
             host_url = request.host_url
             self.args = request.args
         self.upload_id = utils.compute_etag(
@@ -68,12 +71,76 @@ class Upload:
             + "upload/storage/v1/b/%s/o?uploadType=resumable&upload_id=%s"
             % (self.metadata.bucket, self.upload_id)
         )
-        self.media = b""
-        self.committed_size = len(self.media)
+        # The media received so far, as a list of chunks so appending a chunk
+        # does not copy the previous ones.
+        self.chunks = []
+        self.checksums = utils.Checksums()
+        self.committed_size = 0
         self.complete = False
         if resumable:
             utils.insert_upload(self)
 
+    @classmethod
+    def restore(cls, metadata, media, state):
+        """Recreate an upload from its stored state, without inserting it."""
+        upload = cls.__new__(cls)
+        upload.metadata = metadata
+        upload.media = media
+        upload.upload_id = state["upload_id"]
+        upload.location = state["location"]
+        upload.committed_size = state["committed_size"]
+        upload.complete = state["complete"]
+        upload.inject_upload_data_error = state["inject_upload_data_error"]
+        if "args" in state:
+            upload.args = state["args"]
+        return upload
+
+    @property
+    def media(self):
+        if len(self.chunks) > 1:
+            self.chunks = [b"".join(self.chunks)]
+        return self.chunks[0] if len(self.chunks) != 0 else b""
+
+    @media.setter
+    def media(self, media):
+        self.chunks = [bytes(media)] if len(media) != 0 else []
+        self.checksums = utils.Checksums(media)
+        self.committed_size = len(media)
+
+    def read(self, begin):
+        """Return the media received from `begin`, without joining the rest."""
+        chunks = []
+        end = self.committed_size
+        for chunk in reversed(self.chunks):
+            if end <= begin:
+                break
+            start = end - len(chunk)
+            chunks.append(chunk[max(begin - start, 0) :])
+            end = start
+        return b"".join(reversed(chunks))
+
+    def append(self, offset, data):
+        """Add `data`, received for the media at `offset`.
+
+        The part of `data` before `committed_size` was already received (the
+        client is retrying), it is skipped. Data past `committed_size` would
+        leave a gap, it is ignored and the client resumes from the committed
+        size.
+        """
+        if offset > self.committed_size:
+            return
+        data = data[self.committed_size - offset :]
+        if len(data) != 0:
+            self.chunks.append(bytes(data))
+            self.checksums.update(data)
+            self.committed_size += len(data)
+
+    def blob(self):
+        """Store the media, with the digests computed as its chunks arrived."""
+        return gcs_media.store(
+            self.media, self.checksums.md5_hash(), self.checksums.crc32c
+        )
+
     @classmethod
     def lookup(cls, upload_id, context=None):
         upload = utils.lookup_upload(upload_id)
@@ -94,7 +161,6 @@ class Upload:
         response = flask.make_response()
         if self.committed_size > 1 and not self.complete:
             response.headers["Range"] = "bytes=0-%d" % (self.committed_size - 1)
-        response.data = "" if not self.complete else self.media
         response.status_code = 308 if not self.complete else 200
         return response
 
@@ -118,19 +184,22 @@ class Upload:
                     )
                 if self.committed_size == int(items[1]):
                     self.complete = True
+                    utils.update_upload(self, self.committed_size)
                     return
             if items[0] == "*":
                 if self.complete:
                     return self.metadata.name
                 return None
             else:
-                self.media += utils.extract_media(request)
-                self.committed_size = len(self.media)
+                offset = self.committed_size
+                self.append(int(items[0].split("-")[0]), utils.extract_media(request))
                 self.complete = (
                     self.committed_size == int(items[1]) if items[1] != "*" else False
                 )
                 if self.complete and self.inject_upload_data_error:
                     self.media = utils.corrupt_media(self.media)
+                    offset = 0
+                utils.update_upload(self, offset)
 
     def process_request(self, request):
         if isinstance(request, storage.InsertObjectRequest):
@@ -30,9 +30,13 @@ from werkzeug import serving
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
 import gcs_bucket
+import gcs_journal
+import gcs_media
 import gcs_object
 import gcs_project
 import gcs_rewrite
+import gcs_snapshot
+import gcs_sqlite
 import gcs_upload
 import storage_pb2 as storage
 import storage_pb2_grpc
@@ -62,6 +66,7 @@ def insert_test_bucket():
         bucket_test = gcs_bucket.Bucket(json.dumps({"name": bucket_name}))
         bucket_test.metadata.metageneration = 4
         bucket_test.metadata.versioning.enabled = True
+        utils.update_bucket(bucket_test)
 
 
 class StorageServicer(storage_pb2_grpc.StorageServicer):
@@ -91,10 +96,12 @@ class StorageServicer(storage_pb2_grpc.StorageServicer):
     def InsertObject(self, request_iterator, context):
         insert_test_bucket()
         upload = None
+        resumable = False
         for request in request_iterator:
             first_message = request.WhichOneof("first_message")
             if first_message == "upload_id":
                 upload = gcs_upload.Upload.lookup(request.upload_id, context=context)
+                resumable = True
             elif first_message == "insert_object_spec":
                 insert_object_spec = request.insert_object_spec
                 upload = gcs_upload.Upload(
@@ -103,21 +110,36 @@ class StorageServicer(storage_pb2_grpc.StorageServicer):
                     resumable=False,
                     context=context,
                 )
-            upload.media += request.checksummed_data.content
-            upload.committed_size = len(upload.media)
+            offset = upload.committed_size
+            upload.append(request.write_offset, request.checksummed_data.content)
             if request.finish_write:
                 upload.complete = True
+            if resumable:
+                utils.update_upload(upload, offset)
+            if request.finish_write:
                 break
         if not upload.complete:
             utils.abort(400, "Request does not set finish_write", context=context)
-        obj = gcs_object.Object(upload.metadata, upload.media)
-        return obj.metadata
+        obj = gcs_object.Object(upload.metadata, upload.blob())
+        return obj.resolve_md5()
 
     def GetObjectMedia(self, request, context):
         obj = gcs_object.Object.lookup(request.bucket, request.object, request)
         yield storage.GetObjectMediaResponse(
-            checksummed_data={"content": obj.media}, metadata=obj.metadata
+            checksummed_data={"content": obj.blob.read(0, gcs_media.CHUNK_SIZE)},
+            metadata=obj.resolve_md5(),
         )
+        for chunk in obj.blob.chunks(gcs_media.CHUNK_SIZE):
+            yield storage.GetObjectMediaResponse(checksummed_data={"content": chunk})
+
+    def ListObjects(self, request, context):
+        insert_test_bucket()
+        gcs_bucket.Bucket.lookup(request.bucket, context=context)
+        result = resources.ListObjectsResponse()
+        result.items.extend(
+            gcs_object.Object.list(request.bucket, request, result, context=context)
+        )
+        return result
 
     def DeleteObject(self, request, context):
         obj = gcs_object.Object.lookup(request.bucket, request.object, request)
@@ -126,10 +148,11 @@ class StorageServicer(storage_pb2_grpc.StorageServicer):
 
     def StartResumableWrite(self, request, context):
         insert_object_spec = request.insert_object_spec
+        # Set before the upload is inserted, so its (journaled) record has it.
+        insert_object_spec.resource.metadata["x_testbench_upload"] = "resumable"
         upload = gcs_upload.Upload(
             insert_object_spec.resource.bucket, insert_object_spec, context=context
         )
-        upload.metadata.metadata["x_testbench_upload"] = "resumable"
         return storage.StartResumableWriteResponse(upload_id=upload.upload_id)
 
     def QueryWriteStatus(self, request, context):
@@ -158,6 +181,23 @@ def index():
     return "OK"
 
 
+SNAPSHOT_DIRECTORY = None
+
+
+@root.route("/snapshot", methods=["POST"])
+def snapshot_save():
+    """Save the state of the test bench into the `--snapshot` directory."""
+    directory = SNAPSHOT_DIRECTORY
+    if directory is None:
+        utils.abort(400, "The test bench was started without --snapshot")
+    if utils.JOURNAL is not None:
+        # The snapshot restored at startup holds everything before this point.
+        utils.JOURNAL.checkpoint(lambda: gcs_snapshot.save(directory))
+    else:
+        gcs_snapshot.save(directory)
+    return ""
+
+
 # Define the WSGI application to handle bucket requests.
 GCS_HANDLER_PATH = "/storage/v1"
 gcs = flask.Flask(__name__)
@@ -168,14 +208,11 @@ gcs.debug = True
 def buckets_list():
     insert_test_bucket()
     project = flask.request.args.get("project")
-    result = resources.ListBucketsResponse(next_page_token="", items=[])
-    for name, b in gcs_bucket.Bucket.list(project):
-        result.items.append(b.metadata)
-    return utils.message_to_rest(
-        result,
+    return utils.list_to_rest(
+        resources.ListBucketsResponse(),
         "storage#buckets",
+        (b.metadata for name, b in gcs_bucket.Bucket.list(project)),
         flask.request.args.get("fields", None),
-        len(result.items),
     )
 
 
@@ -379,25 +416,25 @@ def bucket_test_iam_permissions(bucket_name):
 def bucket_lock_retention_policy(bucket_name):
     bucket = gcs_bucket.Bucket.lookup(bucket_name)
     bucket.metadata.retention_policy.is_locked = True
+    utils.update_bucket(bucket)
     return bucket.to_rest(flask.request)
 
 
 @gcs.route("/b/<bucket_name>/o")
 def objects_list(bucket_name):
     insert_test_bucket()
-    items, prefixes = gcs_object.Object.list(bucket_name, flask.request.args)
-    result = resources.ListObjectsResponse(items=items, prefixes=prefixes)
-    return utils.message_to_rest(
+    result = resources.ListObjectsResponse()
+    return utils.list_to_rest(
         result,
         "storage#objects",
+        gcs_object.Object.list(bucket_name, flask.request.args, result),
         flask.request.args.get("fields", None),
-        len(result.items),
     )
 
 
 @gcs.route("/b/<bucket_name>/o/<path:object_name>/compose", methods=["POST"])
 def objects_compose(bucket_name, object_name):
-    payload = utils.process_data(flask.request.data)
+    payload = utils.process_data(flask.request.data, storage.ComposeObjectRequest)
     source_objects = payload["sourceObjects"]
     if source_objects is None:
         utils.abort(400, "You must provide at least one source component.")
@@ -407,7 +444,9 @@ def objects_compose(bucket_name, object_name):
             "The number of source components provided"
             " (%d) exceeds the maximum (32)" % len(source_objects),
         )
-    composed_media = b""
+    components = []
+    crc32c = 0
+    component_count = 0
     for source_object in source_objects:
         source_object_name = source_object.get("name")
         if source_object_name is None:
@@ -423,14 +462,22 @@ def objects_compose(bucket_name, object_name):
             source_object_name,
             {"generation": generation, "ifGenerationMatch": if_generation_match},
         )
-        composed_media += obj.media
+        components.append(obj.blob)
+        crc32c = utils.crc32c_combine(
+            crc32c, obj.metadata.crc32c.value, obj.metadata.size
+        )
+        component_count += max(obj.metadata.component_count, 1)
     metadata = {"name": object_name, "bucket": bucket_name}
     metadata.update(payload.get("destination", {}))
+    metadata["componentCount"] = component_count
+    # Like GCS, composite objects have a CRC32C (derived from the components)
+    # but no MD5.
     composed_object = gcs_object.Object(
         metadata,
-        composed_media,
+        gcs_media.CompositeBlob(components),
         flask.request.args,
         flask.request.headers,
+        digests=("", crc32c),
     )
     return composed_object.to_rest(flask.request)
 
@@ -446,14 +493,16 @@ def objects_copy(source_bucket, source_object, destination_bucket, destination_o
     utils.check_object_generation(
         destination_bucket, destination_object, flask.request.args
     )
-    destination_metadata = source_obj.metadata
+    destination_metadata = resources.Object()
+    destination_metadata.CopyFrom(source_obj.metadata)
     destination_metadata.bucket = destination_bucket
     destination_metadata.name = destination_object
     destination_obj = gcs_object.Object(
         destination_metadata,
-        source_obj.media,
+        source_obj.blob,
         flask.request.args,
         flask.request.headers,
+        digests=(source_obj.metadata.md5_hash, source_obj.metadata.crc32c.value),
     )
     destination_obj.update(flask.request.data)
     return destination_obj.to_rest(flask.request)
@@ -579,8 +628,8 @@ def resumable_upload_chunk(bucket_name):
         utils.check_object_generation(
             upload.metadata.bucket, upload.metadata.name, upload.args
         )
-        obj = gcs_object.Object(upload.metadata, upload.media)
-        obj.metadata.metadata["x_testbench_upload"] = "resumable"
+        upload.metadata.metadata["x_testbench_upload"] = "resumable"
+        obj = gcs_object.Object(upload.metadata, upload.blob())
         return obj.to_rest(flask.request, upload.args.get("fields"))
     else:
         return upload.status_rest()
@@ -660,20 +709,22 @@ def xmlapi_put_object(bucket_name, object_name):
 
 
 # Define the WSGI application to handle HMAC key requests
-(PROJECTS_HANDLER_PATH, projects_app) = gcs_project.get_projects_app()
-
-
-application = DispatcherMiddleware(
-    root,
-    {
-        "/httpbin": httpbin.app,
-        GCS_HANDLER_PATH: gcs,
-        UPLOAD_HANDLER_PATH: upload,
-        DOWNLOAD_HANDLER_PATH: download,
-        IAM_HANDLER_PATH: iam,
-        XMLAPI_HANDLER_PATH: xmlapi,
-        PROJECTS_HANDLER_PATH: projects_app,
-    },
+PROJECTS_HANDLER_PATH, projects_app = gcs_project.get_projects_app()
+
+
+application = utils.GzipMiddleware(
+    DispatcherMiddleware(
+        root,
+        {
+            "/httpbin": httpbin.app,
+            GCS_HANDLER_PATH: gcs,
+            UPLOAD_HANDLER_PATH: upload,
+            DOWNLOAD_HANDLER_PATH: download,
+            IAM_HANDLER_PATH: iam,
+            XMLAPI_HANDLER_PATH: xmlapi,
+            PROJECTS_HANDLER_PATH: projects_app,
+        },
+    )
 )
 
 
@@ -698,6 +749,69 @@ if __name__ == "__main__":
     parser.add_argument(
         "--port_rest", default="9000", help="The listening port for REST"
     )
+    parser.add_argument(
+        "--metadata_db",
+        default=None,
+        help="Keep the metadata of buckets and objects in this SQLite database",
+    )
+    parser.add_argument(
+        "--snapshot",
+        default=None,
+        help="Restore the state from this snapshot directory (if it holds one)"
+        " at startup, `POST /snapshot` saves the state into it",
+    )
+    parser.add_argument(
+        "--journal",
+        default=None,
+        help="Log every mutation to this file, and replay it at startup"
+        " (after restoring the snapshot, if any)",
+    )
+    parser.add_argument(
+        "--media_backend",
+        default="memory",
+        choices=["memory", "disk"],
+        help="Where to store the media of objects",
+    )
+    parser.add_argument(
+        "--media_dir",
+        default=None,
+        help="The scratch directory for the disk media backend, or for the"
+        " media spilled by the memory backend",
+    )
+    parser.add_argument(
+        "--media_memory_limit",
+        type=int,
+        default=None,
+        help="Keep at most this many bytes of media in memory, spilling the"
+        " least recently used to files (memory backend only)",
+    )
+    parser.add_argument(
+        "--gzip_level",
+        type=int,
+        default=6,
+        help="The gzip level (0 disables it) of the JSON responses, for the"
+        " clients sending `Accept-Encoding: gzip`",
+    )
+    parser.add_argument(
+        "--gzip_min_size",
+        type=int,
+        default=1024,
+        help="Only compress the JSON responses of at least this many bytes",
+    )
     arguments = parser.parse_args()
+    application.level = arguments.gzip_level
+    application.min_size = arguments.gzip_min_size
+    gcs_media.set_backend(
+        arguments.media_backend, arguments.media_dir, arguments.media_memory_limit
+    )
+    if arguments.metadata_db is not None:
+        utils.set_metadata_store(gcs_sqlite.SqliteStore(arguments.metadata_db))
+    SNAPSHOT_DIRECTORY = arguments.snapshot
+    if SNAPSHOT_DIRECTORY is not None and os.path.exists(
+        os.path.join(SNAPSHOT_DIRECTORY, gcs_snapshot.STATE_FILE)
+    ):
+        gcs_snapshot.load(SNAPSHOT_DIRECTORY)
+    if arguments.journal is not None:
+        utils.set_journal(gcs_journal.Journal(arguments.journal))
     grpc_serve(arguments.port_grpc)
     rest_serve(arguments.port_rest)
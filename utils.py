@@ -13,25 +13,32 @@
 # limitations under the License.
 
 import base64
+import bisect
+import functools
 import json
 import hashlib
+import itertools
 import re
 import struct
-from datetime import timezone
+import sys
+import threading
+import zlib
+from datetime import datetime, timezone
 from random import random
 
 import flask
 import grpc
 from crc32c import crc32
 from dateutil.parser import parse
-from flatdict import FlatterDict
-from google.protobuf.json_format import MessageToDict, ParseDict
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf.json_format import MessageToDict
 from google.protobuf.message import Message
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
 
 import storage_resources_pb2 as resources
 
 # regex
-remove_index = re.compile(r":[0-9]+|^[0-9]+")
 split_fields = re.compile(r"[a-zA-Z0-9]*\(.*\)|[a-zA-Z0-9]+")
 
 
@@ -60,50 +67,194 @@ def compute_md5(content):
     return base64.b64encode(hashlib.md5(content).digest()).decode("utf-8")
 
 
+class Checksums(object):
+    """The running MD5 and CRC32C of some media, updated as its chunks arrive."""
+
+    def __init__(self, media=b""):
+        self.md5 = hashlib.md5()
+        self.crc32c = 0
+        self.update(media)
+
+    def update(self, chunk):
+        self.md5.update(chunk)
+        self.crc32c = crc32(chunk, self.crc32c)
+
+    def md5_hash(self):
+        return base64.b64encode(self.md5.digest()).decode("utf-8")
+
+    def crc32c_hash(self):
+        return encode_crc32c(self.crc32c)
+
+
+# The CRC32C of some data followed by `2^n` zero bytes is a linear function
+# (over GF(2)) of the CRC32C of the data, `_CRC32C_ZEROS[n]` is its matrix.
+_CRC32C_ZEROS = []
+
+
+def _gf2_matrix_times(matrix, vector):
+    result = 0
+    for row in matrix:
+        if vector == 0:
+            break
+        if vector & 1:
+            result ^= row
+        vector >>= 1
+    return result
+
+
+def _crc32c_zeros(n):
+    if len(_CRC32C_ZEROS) == 0:
+        # One zero bit, then square to get one zero byte.
+        matrix = [0x82F63B78] + [1 << i for i in range(31)]
+        for _ in range(3):
+            matrix = [_gf2_matrix_times(matrix, row) for row in matrix]
+        _CRC32C_ZEROS.append(matrix)
+    while len(_CRC32C_ZEROS) <= n:
+        matrix = _CRC32C_ZEROS[-1]
+        _CRC32C_ZEROS.append([_gf2_matrix_times(matrix, row) for row in matrix])
+    return _CRC32C_ZEROS[n]
+
+
+def crc32c_combine(crc1, crc2, length2):
+    """Return the CRC32C of `A + B` given the CRC32C of A, B and the length of B."""
+    n = 0
+    while length2 != 0:
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(_crc32c_zeros(n), crc1)
+        length2 >>= 1
+        n += 1
+    return crc1 ^ crc2
+
+
+def compute_digests(chunks):
+    """Return the MD5 (in base64) and the CRC32C of the concatenated `chunks`."""
+    checksums = Checksums()
+    for chunk in chunks:
+        checksums.update(chunk)
+    return checksums.md5_hash(), checksums.crc32c
+
+
 # protobuf <-> rest
 
 
-def to_dict(source):
-    if not isinstance(source, dict):
-        return source
-    destination_dict = dict()
-    destination_list = list()
-    for key, value in source.items():
-        if key.isdecimal():
-            destination_list.append(to_dict(value))
-        else:
-            destination_dict[key] = to_dict(value)
-    if len(destination_list) != 0:
-        return destination_list
-    else:
-        return destination_dict
+def parse_iso8601(value):
+    """Parse an ISO-8601 date or timestamp, e.g. `2020-01-02T03:04:05Z`."""
+    try:
+        if value.endswith("Z") or value.endswith("z"):
+            value = value[:-1] + "+00:00"
+        return datetime.fromisoformat(value)
+    except ValueError:
+        # Less common formats, e.g. with a non-zero-padded month.
+        return parse(value)
 
 
-def process_data(data):
-    flat = None
+def _created_before(value):
+    if value is None:
+        return value
+    return parse_iso8601(value).replace(tzinfo=timezone.utc).isoformat()
+
+
+# The older names of some fields, accepted in the request bodies.
+_JSON_ALIASES = {
+    "google.storage.v1.Bucket.IamConfiguration": {
+        "bucketPolicyOnly": "uniformBucketLevelAccess"
+    },
+}
+
+
+def _compile_fixups(descriptor):
+    """Compile the fixups to apply to a request body for a `descriptor` message.
+
+    Return a `dict` mapping the JSON name of the fields needing a fixup to the
+    function applying it to their value (or `None` to drop them if they are
+    `null`), and the `dict` of the aliases of the fields. Both are empty if
+    neither the message nor its submessages need any fixup.
+    """
+    fixups = dict()
+    for field in descriptor.fields:
+        if field.message_type is None:
+            continue
+        if field.message_type.full_name == "google.protobuf.Timestamp":
+            if field.name == "created_before":
+                fixups[field.json_name] = _created_before
+            elif field.name == "updated":
+                fixups[field.json_name] = None
+            continue
+        if field.message_type.GetOptions().map_entry:
+            value_field = field.message_type.fields_by_name["value"]
+            if value_field.message_type is None:
+                continue
+            child = _fix_message(value_field.message_type)
+            if child is not None:
+                fixups[field.json_name] = lambda value, child=child: (
+                    {k: child(v) for k, v in value.items()}
+                    if isinstance(value, dict)
+                    else value
+                )
+            continue
+        child = _fix_message(field.message_type)
+        if child is None:
+            continue
+        if field.label == FieldDescriptor.LABEL_REPEATED:
+            fixups[field.json_name] = lambda value, child=child: (
+                [child(v) for v in value] if isinstance(value, list) else value
+            )
+        else:
+            fixups[field.json_name] = child
+    return fixups, _JSON_ALIASES.get(descriptor.full_name, dict())
+
+
+@functools.lru_cache(maxsize=None)
+def _fix_message(descriptor):
+    """Return a function applying the fixups of `descriptor`, or `None`."""
+    if descriptor.full_name.startswith("google.protobuf."):
+        return None
+    fixups, aliases = _compile_fixups(descriptor)
+    if len(fixups) == 0 and len(aliases) == 0:
+        return None
+
+    def fix(data):
+        if not isinstance(data, dict):
+            return data
+        data = dict(data)
+        for alias, name in aliases.items():
+            if alias not in data:
+                continue
+            value = data.pop(alias)
+            if name not in data:
+                data[name] = value
+            elif isinstance(data[name], dict) and isinstance(value, dict):
+                data[name] = {**value, **data[name]}
+        for name, fixup in fixups.items():
+            if name not in data:
+                continue
+            if fixup is not None:
+                data[name] = fixup(data[name])
+            elif data[name] is None:
+                del data[name]
+        return data
+
+    return fix
+
+
+def process_data(data, message_type):
+    """Parse a request body into a `dict`, ready for `ParseDict` as `message_type`.
+
+    The fixups (e.g. the older names of some fields) are applied in a single
+    pass, guided by the descriptor of `message_type`, and skipped entirely
+    when the body cannot need any.
+    """
     if isinstance(data, bytes) or isinstance(data, str):
-        flat = FlatterDict(json.loads(data))
+        data = json.loads(data)
     elif isinstance(data, dict):
-        flat = FlatterDict(data)
+        data = dict(data)
     else:
         abort(500, "Data must be dict or bytes")
-    delete_keys = []
-    for key in flat.keys():
-        if key.endswith("createdBefore"):
-            flat[key] = parse(flat[key]).replace(tzinfo=timezone.utc).isoformat()
-        if "bucketPolicyOnly" in key:
-            new_key = key.replace("bucketPolicyOnly", "uniformBucketLevelAccess", 1)
-            if flat.get(new_key) is None:
-                flat[new_key] = flat[key]
-            delete_keys.append(key)
-        if flat[key] is None:
-            if key.endswith("updated"):
-                delete_keys.append(key)
-        if key == "kind":
-            delete_keys.append(key)
-    for key in delete_keys:
-        del flat[key]
-    return to_dict(flat.as_dict())
+    data.pop("kind", None)
+    fix = _fix_message(message_type.DESCRIPTOR)
+    if fix is None:
+        return data
+    return fix(data)
 
 
 def fields_to_list(fields):
@@ -126,33 +277,258 @@ def fields_to_list(fields):
     return result
 
 
+def _fields_to_mask(fields):
+    """Return the tree of the fields selected by `fields`.
+
+    Each node maps a field name to the node of its subfields, or to `None` if
+    the field is selected with all its subfields.
+    """
+    mask = dict()
+    for path in fields_to_list(fields):
+        node = mask
+        names = path.split(":")
+        for name in names[:-1]:
+            if name in node and node[name] is None:
+                break
+            node = node.setdefault(name, dict())
+        else:
+            node[names[-1]] = None
+    return mask
+
+
+def _wkt_to_rest(descriptor):
+    if descriptor.full_name == "google.protobuf.Timestamp":
+        return lambda value: value.ToJsonString()
+    if descriptor.full_name.endswith("Value") and "value" in descriptor.fields_by_name:
+        convert = _scalar_to_rest(descriptor.fields_by_name["value"])
+        if convert is None:
+            return lambda value: value.value
+        return lambda value: convert(value.value)
+    return MessageToDict
+
+
+def _scalar_to_rest(field):
+    """Return how `MessageToDict` converts the values of `field`, or `None`."""
+    if field.cpp_type in (
+        FieldDescriptor.CPPTYPE_INT64,
+        FieldDescriptor.CPPTYPE_UINT64,
+    ):
+        return str
+    if field.cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+        values = field.enum_type.values_by_number
+        return lambda value: values[value].name if value in values else value
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        return lambda value: base64.b64encode(value).decode("utf-8")
+    return None
+
+
+def _value_to_rest(field, key, mask, preserving_proto_field_name):
+    """Return a function converting a (single) value of `field` to REST."""
+    if field.message_type is None:
+        convert = _scalar_to_rest(field)
+        if key.endswith("crc32c"):
+            return encode_crc32c
+        return convert if convert is not None else lambda value: value
+    if key.endswith("createdBefore"):
+        return lambda value: value.ToDatetime().strftime("%Y-%m-%d")
+    if field.message_type.full_name.startswith("google.protobuf."):
+        convert = _wkt_to_rest(field.message_type)
+        if key.endswith("crc32c"):
+            return lambda value: encode_crc32c(convert(value))
+        return convert
+    plan = None
+
+    def message(value):
+        # The plan is compiled on first use, so recursive messages terminate.
+        nonlocal plan
+        if plan is None:
+            plan = _compile_projector(
+                field.message_type, mask, preserving_proto_field_name
+            )
+        return _project(value, plan)
+
+    return message
+
+
+def _compile_field(field, mask, preserving_proto_field_name):
+    key = field.name if preserving_proto_field_name else field.json_name
+    if field.message_type is not None and field.message_type.GetOptions().map_entry:
+        value_field = field.message_type.fields_by_name["value"]
+        if mask is None:
+            convert = _value_to_rest(
+                value_field, key, None, preserving_proto_field_name
+            )
+            return key, lambda value: {str(k): convert(v) for k, v in value.items()}
+        # The mask selects some entries of the map.
+        converts = {
+            name: _value_to_rest(value_field, key, child, preserving_proto_field_name)
+            for name, child in mask.items()
+        }
+        return key, lambda value: {
+            str(k): converts[str(k)](v) for k, v in value.items() if str(k) in converts
+        }
+    convert = _value_to_rest(field, key, mask, preserving_proto_field_name)
+    if field.label == FieldDescriptor.LABEL_REPEATED:
+        return key, lambda value: [convert(v) for v in value]
+    return key, convert
+
+
+def _compile_projector(descriptor, mask, preserving_proto_field_name):
+    """Compile the plan to convert a `descriptor` message, restricted to `mask`.
+
+    The plan maps the name of each field to emit to its REST key, a function
+    converting its value, and whether only some of its subfields are emitted.
+    """
+    if mask is None:
+        mask = {
+            (field.name if preserving_proto_field_name else field.json_name): None
+            for field in descriptor.fields
+        }
+    plan = dict()
+    for field in descriptor.fields:
+        key = field.name if preserving_proto_field_name else field.json_name
+        if key not in mask:
+            continue
+        child = mask[key]
+        if child is not None and field.message_type is None:
+            continue
+        plan[field.name] = _compile_field(field, child, preserving_proto_field_name) + (
+            child is not None,
+        )
+    return plan
+
+
+def _project(message, plan):
+    result = dict()
+    for field, value in message.ListFields():
+        compiled = plan.get(field.name)
+        if compiled is None:
+            continue
+        key, convert, masked = compiled
+        value = convert(value)
+        if masked and len(value) == 0:
+            # None of the selected subfields is set.
+            continue
+        result[key] = value
+    return result
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_message(descriptor, fields, projection, preserving_proto_field_name):
+    mask = None if fields is None else _fields_to_mask(fields)
+    plan = _compile_projector(descriptor, mask, preserving_proto_field_name)
+    if projection == "noAcl":
+        for name in ("acl", "default_object_acl", "owner"):
+            plan.pop(name, None)
+    # Whether to emit the `kind` of the message, and of the listed items.
+    items = mask.get("items", dict()) if mask is not None else None
+    return (
+        plan,
+        mask is None or "kind" in mask,
+        items is None or "kind" in items,
+    )
+
+
+def list_item_fields(fields):
+    """Return the names of the fields of the items selected by `fields`.
+
+    `fields` selects the fields of a list (e.g. `items(name),nextPageToken`),
+    return `None` if it selects all the fields of its items.
+    """
+    if fields is None:
+        return None
+    mask = _fields_to_mask(fields)
+    if "items" not in mask:
+        return set()
+    return set(mask["items"]) if mask["items"] is not None else None
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_items(descriptor, fields):
+    """Compile the conversion of the `items` of a list, `None` if not selected."""
+    mask = None if fields is None else _fields_to_mask(fields)
+    if mask is not None and "items" not in mask:
+        return None
+    field = descriptor.fields_by_name["items"]
+    return _value_to_rest(
+        field, field.json_name, mask["items"] if mask is not None else None, False
+    )
+
+
 def message_to_rest(
     message,
     kind,
     fields=None,
     list_size=0,
     preserving_proto_field_name=False,
+    projection=None,
 ):
-    flat = FlatterDict(
-        MessageToDict(message, preserving_proto_field_name=preserving_proto_field_name)
+    """Convert `message` to its REST representation, a `dict`.
+
+    Only the parts of `message` selected by `fields` are converted, omitting
+    the ACLs when `projection` is `noAcl`. The conversion of each type of
+    message is compiled once, and cached.
+    """
+    plan, with_kind, with_item_kind = _compile_message(
+        message.DESCRIPTOR, fields, projection, preserving_proto_field_name
+    )
+    result = _project(message, plan)
+    if with_kind:
+        result["kind"] = kind
+    if list_size != 0 and with_item_kind:
+        for item in result.get("items", [])[:list_size]:
+            item.setdefault("kind", kind[:-1])
+    return result
+
+
+# The size of the JSON text of the items buffered by a streaming list.
+LIST_BUFFER_SIZE = 64 * 1024
+
+
+def list_to_rest(response, kind, items, fields=None):
+    """Return a streaming REST response for a list of resources.
+
+    `response` is the message of the list (e.g. a `ListObjectsResponse`), but
+    its items come from the iterable `items`. They are converted and written
+    one at a time, then the other fields of `response` are written, so these
+    may be set while `items` is iterated.
+    """
+    _, _, with_item_kind = _compile_message(response.DESCRIPTOR, fields, None, False)
+    convert = _compile_items(response.DESCRIPTOR, fields)
+    items = iter(items)
+    # Get the first item now, so errors (e.g. a missing bucket) are reported
+    # with their status code rather than after the response started.
+    first = list(itertools.islice(items, 1))
+
+    def generate():
+        started = False
+        buffer = []
+        size = 0
+        for item in itertools.chain(first, items):
+            if convert is None:
+                continue
+            item = convert(item)
+            if with_item_kind:
+                item.setdefault("kind", kind[:-1])
+            buffer.append(json.dumps(item))
+            size += len(buffer[-1])
+            if size >= LIST_BUFFER_SIZE:
+                yield (", " if started else '{"items": [') + ", ".join(buffer)
+                started, buffer, size = True, [], 0
+        if len(buffer) != 0:
+            yield (", " if started else '{"items": [') + ", ".join(buffer)
+            started = True
+        rest = json.dumps(message_to_rest(response, kind, fields))
+        if not started:
+            yield rest
+        elif rest == "{}":
+            yield "]}"
+        else:
+            yield "], " + rest[1:]
+
+    return flask.Response(
+        flask.stream_with_context(generate()), mimetype="application/json"
     )
-    keep = fields_to_list(fields)
-    for i in range(list_size):
-        flat.setdefault("items:%d:kind" % i, kind[:-1])
-    flat["kind"] = kind
-    delete_key = []
-    for key in flat.keys():
-        if key.endswith("createdBefore"):
-            flat[key] = parse(flat[key]).strftime("%Y-%m-%d")
-        if key.endswith("crc32c"):
-            flat[key] = encode_crc32c(flat[key])
-        if fields is not None:
-            re_key = remove_index.sub("", key)
-            if re_key not in keep:
-                delete_key.append(key)
-    for key in delete_key:
-        del flat[key]
-    return to_dict(flat.as_dict())
 
 
 # rest
@@ -228,6 +604,96 @@ def extract_encryption(request):
     }
 
 
+# compression
+
+
+class GzipMiddleware(object):
+    """Compress the JSON responses of a WSGI application with gzip.
+
+    Only the responses to clients accepting gzip, and of at least `min_size`
+    bytes, are compressed. At most `min_size` bytes of a response are buffered
+    to decide, then each chunk is compressed (and flushed) as the application
+    produces it, so streaming responses keep streaming. A `level` of 0
+    disables the compression.
+    """
+
+    def __init__(self, application, level=6, min_size=1024):
+        self.application = application
+        self.level = level
+        self.min_size = min_size
+
+    def __call__(self, environ, start_response):
+        accept = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if (
+            self.level == 0
+            or environ.get("REQUEST_METHOD") == "HEAD"
+            or accept.quality("gzip") == 0
+        ):
+            return self.application(environ, start_response)
+        response = []
+        head = []
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers, exc_info]
+            return head.append
+
+        body = self.application(environ, capture)
+        chunks = iter(body)
+        while len(response) == 0:
+            head.append(next(chunks))
+        status, headers, exc_info = response
+        if not self.__compressible(status, Headers(headers)):
+            start_response(status, headers, exc_info)
+            return body if len(head) == 0 else self.__stream(head, chunks, body)
+        size = sum(len(chunk) for chunk in head)
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self.min_size:
+                break
+        else:
+            # The application produced less than `min_size` bytes.
+            start_response(status, headers, exc_info)
+            return self.__stream(head, chunks, body)
+        headers = Headers(headers)
+        headers.remove("Content-Length")
+        headers["Content-Encoding"] = "gzip"
+        headers.add("Vary", "Accept-Encoding")
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return self.__stream(
+            head,
+            chunks,
+            body,
+            zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+        )
+
+    def __compressible(self, status, headers):
+        if int(status.split(" ", 1)[0]) in (204, 304):
+            return False
+        if "Content-Encoding" in headers:
+            return False
+        if not headers.get("Content-Type", "").startswith("application/json"):
+            return False
+        length = headers.get("Content-Length")
+        return length is None or int(length) >= self.min_size
+
+    @staticmethod
+    def __stream(head, chunks, body, compressor=None):
+        try:
+            for chunk in itertools.chain(head, chunks):
+                if compressor is not None:
+                    chunk = compressor.compress(chunk) + compressor.flush(
+                        zlib.Z_SYNC_FLUSH
+                    )
+                if len(chunk) != 0:
+                    yield chunk
+            if compressor is not None:
+                yield compressor.flush()
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+
+
 # error
 
 
@@ -282,79 +748,495 @@ def corrupt_media(media):
 
 GCS_BUCKETS = dict()
 GCS_OBJECTS = dict()
+GCS_OBJECT_NAMES = dict()
+GCS_OBJECT_VERSIONS = dict()
+GCS_OBJECT_VERSION_NAMES = dict()
+GCS_OBJECT_LOCKS = dict()
 GCS_UPLOADS = dict()
 GCS_REWRITES = dict()
 
+# An optional store (e.g. `gcs_sqlite.SqliteStore`) replacing the dicts above
+# for the metadata of buckets and objects.
+METADATA_STORE = None
 
+
+def set_metadata_store(store):
+    global METADATA_STORE
+    METADATA_STORE = store
+
+
+# An optional log (e.g. `gcs_journal.Journal`) recording every mutation made
+# through the functions decorated with `journaled`.
+JOURNAL = None
+_journal_local = threading.local()
+
+
+def set_journal(journal):
+    global JOURNAL
+    JOURNAL = journal
+
+
+def journaled(function):
+    """Record each (outermost) call to `function` in the journal, if any.
+
+    The mutation is applied and appended to the journal under the journal
+    lock, so the journal sees the mutations in the order they are applied,
+    then the caller waits until the journal is flushed to disk.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        journal = JOURNAL
+        if journal is None or getattr(_journal_local, "active", False):
+            return function(*args, **kwargs)
+        with journal.lock:
+            _journal_local.active = True
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                _journal_local.active = False
+            sequence = journal.append(function.__name__, *args, **kwargs)
+        journal.wait(sequence)
+        return result
+
+    return wrapper
+
+
+@journaled
 def insert_bucket(bucket):
+    if METADATA_STORE is not None:
+        return METADATA_STORE.insert_bucket(bucket)
     GCS_BUCKETS[bucket.metadata.name] = bucket
     GCS_OBJECTS[bucket.metadata.name] = dict()
+    GCS_OBJECT_NAMES[bucket.metadata.name] = SortedIndex()
+    GCS_OBJECT_VERSIONS[bucket.metadata.name] = dict()
+    GCS_OBJECT_VERSION_NAMES[bucket.metadata.name] = SortedIndex()
+    GCS_OBJECT_LOCKS.setdefault(bucket.metadata.name, threading.Lock())
+
+
+@journaled
+def update_bucket(bucket):
+    """Record the changes made to a bucket after its insertion."""
+    bucket.rest_cache.clear()
+    if METADATA_STORE is not None:
+        return METADATA_STORE.update_bucket(bucket)
 
 
 def lookup_bucket(bucket_name):
+    if METADATA_STORE is not None:
+        return METADATA_STORE.lookup_bucket(bucket_name)
     return GCS_BUCKETS.get(bucket_name, None)
 
 
 def all_buckets():
-    return GCS_BUCKETS.items()
+    if METADATA_STORE is not None:
+        return METADATA_STORE.all_buckets()
+    return list(GCS_BUCKETS.items())
 
 
+@journaled
 def delete_bucket(bucket_name):
-    del GCS_BUCKETS[bucket_name]
-    del GCS_OBJECTS[bucket_name]
+    if METADATA_STORE is not None:
+        METADATA_STORE.delete_bucket(bucket_name)
+    else:
+        # The lock outlives the bucket: a writer waiting on it sees the bucket
+        # gone (or replaced by a new one with the same name) once it gets it.
+        with GCS_OBJECT_LOCKS[bucket_name]:
+            del GCS_BUCKETS[bucket_name]
+            del GCS_OBJECTS[bucket_name]
+            del GCS_OBJECT_NAMES[bucket_name]
+            del GCS_OBJECT_VERSIONS[bucket_name]
+            del GCS_OBJECT_VERSION_NAMES[bucket_name]
     delete_upload = [
         upload_id
-        for upload_id, upload in GCS_UPLOADS.items()
+        for upload_id, upload in list(GCS_UPLOADS.items())
         if upload.metadata.bucket == bucket_name
     ]
     for upload_id in delete_upload:
         del GCS_UPLOADS[upload_id]
 
 
-def all_objects(bucket_name, versions):
-    bucket = GCS_OBJECTS.get(bucket_name)
-    if bucket is None:
+# objects
+#
+# GCS_OBJECTS maps each bucket to its live objects by name, and
+# GCS_OBJECT_VERSIONS maps each name to its version chain: a dict from
+# generation to object, oldest first: the generations are appended as they are
+# created, so the live generation (if any) is the last one. The sorted
+# indexes GCS_OBJECT_NAMES and GCS_OBJECT_VERSION_NAMES map the names present in
+# each of them to the live object and to a tuple copy of the version chain,
+# sorted by generation (the order of the listings in every metadata store).
+# Listings are range scans over a snapshot of the index, they do not see the
+# objects inserted or deleted while they run. The changes to the objects of a
+# bucket are serialized by its lock in GCS_OBJECT_LOCKS, and each change swaps
+# the entry of the name in each index at most once.
+
+# The maximum number of names in a chunk of a `SortedIndex`, a chunk is split
+# in two halves when it gets larger.
+INDEX_CHUNK_SIZE = 1024
+
+
+class SortedIndex(object):
+    """A sorted map from names to values, with constant time snapshots.
+
+    `state` is a `(firsts, chunks)` pair of tuples: each chunk is a
+    `(names, values)` pair of tuples, `firsts` holds the first name of each
+    chunk. Nothing reachable from `state` is modified, a mutation copies the
+    chunk it changes (and the top-level tuples) then replaces `state`, so a
+    snapshot is a reference to `state` and its readers never take a lock.
+    The writers must be serialized by the caller.
+    """
+
+    def __init__(self):
+        self.state = ((), ())
+
+    def snapshot(self):
+        return self.state
+
+    def __replace(self, firsts, chunks, i, replacement):
+        self.state = (
+            firsts[:i] + tuple(names[0] for names, _ in replacement) + firsts[i + 1 :],
+            chunks[:i] + replacement + chunks[i + 1 :],
+        )
+
+    def set(self, name, value):
+        firsts, chunks = self.state
+        if len(chunks) == 0:
+            self.state = ((name,), (((name,), (value,)),))
+            return
+        i = max(bisect.bisect_right(firsts, name) - 1, 0)
+        names, values = chunks[i]
+        j = bisect.bisect_left(names, name)
+        if j < len(names) and names[j] == name:
+            if values[j] is value:
+                return
+            values = values[:j] + (value,) + values[j + 1 :]
+        else:
+            names = names[:j] + (name,) + names[j:]
+            values = values[:j] + (value,) + values[j:]
+        if len(names) > INDEX_CHUNK_SIZE:
+            half = len(names) // 2
+            replacement = (
+                (names[:half], values[:half]),
+                (names[half:], values[half:]),
+            )
+        else:
+            replacement = ((names, values),)
+        self.__replace(firsts, chunks, i, replacement)
+
+    def remove(self, name):
+        firsts, chunks = self.state
+        i = bisect.bisect_right(firsts, name) - 1
+        if i < 0:
+            return
+        names, values = chunks[i]
+        j = bisect.bisect_left(names, name)
+        if j == len(names) or names[j] != name:
+            return
+        names = names[:j] + names[j + 1 :]
+        values = values[:j] + values[j + 1 :]
+        self.__replace(firsts, chunks, i, ((names, values),) if len(names) != 0 else ())
+
+    @staticmethod
+    def scan(snapshot, start):
+        """Yield the `(name, value)` pairs of `snapshot` from `start` on."""
+        firsts, chunks = snapshot
+        for i in range(max(bisect.bisect_right(firsts, start) - 1, 0), len(chunks)):
+            names, values = chunks[i]
+            for j in range(bisect.bisect_left(names, start), len(names)):
+                yield names[j], values[j]
+
+
+def prefix_successor(prefix):
+    """Return the first string after all those starting with `prefix`.
+
+    Return `None` if there is none, i.e. `prefix` is only made of the last
+    code point.
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if prefix == "":
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_glob(glob):
+    """Compile a matchGlob pattern, return its literal prefix and its regex.
+
+    `*` matches any characters but `/`, `**` any characters, `**/` any
+    (possibly empty) sequence of directories, `?` any character but `/`,
+    `[abc]`, `[!abc]` and `[a-z]` a character (not) in the set, and `{a,b}`
+    either of the patterns. All the names matching the pattern start with the
+    literal prefix, i.e. the pattern up to its first special character.
+
+    Return `None` if the pattern is invalid.
+    """
+    literal = re.match(r"[^*?\[{]*", glob).group(0)
+    regex = []
+    depth = 0
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+            continue
+        if glob.startswith("**", i):
+            regex.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            regex.append("[^/]*")
+        elif c == "?":
+            regex.append("[^/]")
+        elif c == "[" and glob.find("]", i + 2) != -1:
+            end = glob.find("]", i + 2)
+            chars = glob[i + 1 : end]
+            negate = chars.startswith("!")
+            if negate:
+                chars = chars[1:]
+            # Only `-` (for ranges) keeps its meaning in the set.
+            chars = "".join("\\" + c if c in "\\[]^&~|" else c for c in chars)
+            regex.append("[" + ("^" if negate else "") + chars + "]")
+            i = end + 1
+            continue
+        elif c == "{":
+            regex.append("(?:")
+            depth += 1
+        elif c == "," and depth > 0:
+            regex.append("|")
+        elif c == "}" and depth > 0:
+            regex.append(")")
+            depth -= 1
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    if depth != 0:
+        return None
+    try:
+        return literal, re.compile("".join(regex), re.DOTALL).fullmatch
+    except re.error:
+        return None
+
+
+def delimited_prefix(name, prefix, delimiter):
+    """Return the prefix (up to the delimiter) collapsing `name` in a listing.
+
+    Return `None` if `name` is listed itself, i.e. there is no delimiter or it
+    does not contain the delimiter after `prefix`.
+    """
+    if delimiter == "":
+        return None
+    delimiter_index = name.find(delimiter, len(prefix))
+    if delimiter_index <= 0:
+        return None
+    return name[: delimiter_index + len(delimiter)]
+
+
+def all_objects(
+    bucket_name,
+    versions,
+    prefix="",
+    start_offset="",
+    end_offset="",
+    start_generation=None,
+    delimiter="",
+    match=None,
+    names_only=False,
+):
+    """Yield the objects of a bucket in name order.
+
+    Only the names in `[max(prefix, start_offset), end_offset)` that start with
+    `prefix` are visited. With `versions` every generation of each name is
+    returned, by increasing generation, otherwise only the live generation.
+    With `start_generation` the generations of the name `start_offset` up to
+    this one (included) are skipped, to resume a listing after it, even if
+    this generation was deleted since.
+
+    With a `delimiter`, the names collapsed into a prefix (see
+    `delimited_prefix`) are not returned: the prefix (a `str`) is returned
+    once instead, and the scan seeks past all the names starting with it.
+    With `match` (e.g. from `compile_glob`), the names it does not match are
+    skipped, before they are collapsed. With `names_only` the metadata of the
+    objects may only hold their bucket, name and generation, the metadata
+    store then does not load the rest.
+
+    The objects are those of the bucket when the listing starts, the objects
+    inserted or deleted while it runs are not visible.
+    """
+    if METADATA_STORE is not None:
+        yield from METADATA_STORE.all_objects(
+            bucket_name,
+            versions,
+            prefix,
+            start_offset,
+            end_offset,
+            start_generation,
+            delimiter,
+            match,
+            names_only,
+        )
+        return
+    index = (GCS_OBJECT_VERSION_NAMES if versions else GCS_OBJECT_NAMES).get(
+        bucket_name
+    )
+    if index is None:
         abort(404, "Bucket %s does not exist" % bucket_name)
-    return [
-        obj
-        for object_key, obj in bucket.items()
-        if versions or (not versions and object_key == obj.metadata.name)
-    ]
+    snapshot = index.snapshot()
+    seek = max(prefix, start_offset)
+    while seek is not None:
+        entries = SortedIndex.scan(snapshot, seek)
+        seek = None
+        for name, value in entries:
+            if not name.startswith(prefix):
+                break
+            if end_offset != "" and name >= end_offset:
+                break
+            if match is not None and match(name) is None:
+                continue
+            name_prefix = delimited_prefix(name, prefix, delimiter)
+            if name_prefix is not None:
+                yield name_prefix
+                seek = prefix_successor(name_prefix)
+                break
+            if not versions:
+                yield value
+                continue
+            chain = value
+            if start_generation is not None and name == start_offset:
+                chain = [
+                    obj for obj in chain if obj.metadata.generation > start_generation
+                ]
+            yield from chain
 
 
 def lookup_object(bucket_name, object_name, current_generation="", context=None):
+    if METADATA_STORE is not None:
+        return METADATA_STORE.lookup_object(
+            bucket_name, object_name, current_generation, context=context
+        )
     bucket = GCS_OBJECTS.get(bucket_name)
     if bucket is None:
         abort(404, "Bucket %s does not exist" % bucket_name, context=context)
-    obj = bucket.get(object_name)
     if current_generation == "":
-        return obj
-    else:
-        if obj is None:
-            return bucket.get(object_name + "#" + current_generation)
-        elif str(obj.metadata.generation) == current_generation:
-            return obj
+        return bucket.get(object_name)
+    chain = GCS_OBJECT_VERSIONS[bucket_name].get(object_name)
+    if chain is None or not current_generation.isdecimal():
+        return None
+    return chain.get(int(current_generation))
 
 
-def delete_object(bucket_name, object_name):
+@journaled
+def delete_object(bucket_name, object_name, generation=None):
+    """Delete the live generation of an object, or one of its generations.
+
+    Deleting the live generation in a bucket with versioning enabled keeps it
+    in the version chain as a noncurrent generation, otherwise the generation
+    is removed from the chain.
+    """
     # TODO(vnvo2409): updated and deleted time
+    if METADATA_STORE is not None:
+        return METADATA_STORE.delete_object(bucket_name, object_name, generation)
     bucket = GCS_BUCKETS.get(bucket_name)
     if bucket is None:
         abort(404, "Bucket %s does not exist" % bucket_name)
-    obj = GCS_OBJECTS[bucket_name].get(object_name)
-    if obj is not None and bucket.metadata.versioning.enabled:
-        GCS_OBJECTS[bucket_name][
-            obj.metadata.name + "#" + str(obj.metadata.generation)
-        ] = obj
-    return GCS_OBJECTS[bucket_name].pop(object_name, None)
+    with GCS_OBJECT_LOCKS[bucket_name]:
+        if GCS_BUCKETS.get(bucket_name) is not bucket:
+            abort(404, "Bucket %s does not exist" % bucket_name)
+        obj = _remove_object(bucket, object_name, generation)
+        _publish_object(bucket_name, object_name)
+    return obj
 
 
+@journaled
 def insert_object(bucket_name, obj):
-    bucket = GCS_OBJECTS.get(bucket_name)
+    if METADATA_STORE is not None:
+        return METADATA_STORE.insert_object(bucket_name, obj)
+    bucket = GCS_BUCKETS.get(bucket_name)
     if bucket is None:
         abort(404, "Bucket %s does not exist" % bucket_name)
-    delete_object(bucket_name, obj.metadata.name)
-    GCS_OBJECTS[bucket_name][obj.metadata.name] = obj
+    # The previous live generation is replaced in the indexes, listings see
+    # either generation but never a missing object.
+    with GCS_OBJECT_LOCKS[bucket_name]:
+        if GCS_BUCKETS.get(bucket_name) is not bucket:
+            abort(404, "Bucket %s does not exist" % bucket_name)
+        _remove_object(bucket, obj.metadata.name, None)
+        _add_object(bucket_name, obj, True)
+        _publish_object(bucket_name, obj.metadata.name)
+
+
+def restore_object(bucket_name, obj, live):
+    """Add a generation at the end of its version chain, as is.
+
+    Unlike `insert_object` the current live generation (if any) is left
+    untouched, this is used to rebuild the chains from a snapshot.
+    """
+    if METADATA_STORE is not None:
+        return METADATA_STORE.restore_object(bucket_name, obj, live)
+    with GCS_OBJECT_LOCKS[bucket_name]:
+        _add_object(bucket_name, obj, live)
+        _publish_object(bucket_name, obj.metadata.name)
+
+
+# The helpers below are called with the lock of the bucket held, the first two
+# change the dicts and `_publish_object` then updates the indexes.
+
+
+def _remove_object(bucket, object_name, generation):
+    bucket_name = bucket.metadata.name
+    live = GCS_OBJECTS[bucket_name].get(object_name)
+    chain = GCS_OBJECT_VERSIONS[bucket_name].get(object_name)
+    if chain is None:
+        return None
+    if generation is None or (
+        live is not None and live.metadata.generation == generation
+    ):
+        if live is None:
+            return None
+        del GCS_OBJECTS[bucket_name][object_name]
+        if bucket.metadata.versioning.enabled:
+            live.rest_cache.clear()
+            return live
+        generation = live.metadata.generation
+    obj = chain.pop(generation, None)
+    if len(chain) == 0:
+        del GCS_OBJECT_VERSIONS[bucket_name][object_name]
+    return obj
+
+
+def _add_object(bucket_name, obj, live):
+    name = obj.metadata.name
+    if live:
+        GCS_OBJECTS[bucket_name][name] = obj
+    chain = GCS_OBJECT_VERSIONS[bucket_name].setdefault(name, dict())
+    chain[obj.metadata.generation] = obj
+
+
+def _object_generation(obj):
+    return obj.metadata.generation
+
+
+def _publish_object(bucket_name, name):
+    """Set the entries of `name` in the indexes from the dicts, in one swap each."""
+    live = GCS_OBJECTS[bucket_name].get(name)
+    if live is not None:
+        GCS_OBJECT_NAMES[bucket_name].set(name, live)
+    else:
+        GCS_OBJECT_NAMES[bucket_name].remove(name)
+    chain = GCS_OBJECT_VERSIONS[bucket_name].get(name)
+    if chain is not None:
+        GCS_OBJECT_VERSION_NAMES[bucket_name].set(
+            name, tuple(sorted(chain.values(), key=_object_generation))
+        )
+    else:
+        GCS_OBJECT_VERSION_NAMES[bucket_name].remove(name)
+
+
+@journaled
+def update_object(obj):
+    """Record the changes made to an object after its insertion."""
+    obj.rest_cache.clear()
+    if METADATA_STORE is not None:
+        return METADATA_STORE.update_object(obj)
 
 
 def check_object_generation(
@@ -424,17 +1306,44 @@ def lookup_upload(upload_id):
     return GCS_UPLOADS.get(upload_id)
 
 
+@journaled
 def delete_upload(upload_id):
     GCS_UPLOADS.pop(upload_id, None)
 
 
+@journaled
 def insert_upload(upload):
     GCS_UPLOADS[upload.upload_id] = upload
 
 
+@journaled
+def update_upload(upload, offset):
+    """Record the media appended to an upload from `offset`, and its state."""
+
+
+def all_uploads():
+    return list(GCS_UPLOADS.values())
+
+
 # ACL
 
 
+def find_acl(acls, index, entity):
+    """Return the position of the (first) entry of `acls` for `entity`.
+
+    `index` maps the entities to their position in `acls`, it is rebuilt when
+    it does not match `acls` (e.g. the ACL was changed or replaced), so only
+    these lookups scan the entries. Return `None` if there is no such entry.
+    """
+    position = index.get(entity)
+    if position is None or position >= len(acls) or acls[position].entity != entity:
+        index.clear()
+        for i, acl in enumerate(acls):
+            index.setdefault(acl.entity, i)
+        position = index.get(entity)
+    return position
+
+
 def make_object_acl_proto(bucket_name, entity, role, object_name=""):
     return resources.ObjectAccessControl(
         bucket=bucket_name, entity=entity, role=role, object=object_name